@@ -0,0 +1,482 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Find the administrative areas containing points.
+
+Areas come from verify_admin (admins with polygons) or from a GeoJSON
+or WKB export of uganda_build. Points are given on the command line
+input (one "lon lat" per line) or through a local socket.
+"""
+
+import sys
+import os
+import math
+import json
+import struct
+import optparse
+import SocketServer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import logo
+import uganda_config
+
+
+class PreparedRing:
+    """
+    Ring edges dispatched into horizontal bands.
+
+    A point is only checked against the edges of its band, with the ray
+    crossing rule of ringue.ringcontains (point on a vertex is 'in').
+    """
+
+    def __init__(self, coords, bandsize=8):
+        self.ymin = min([ coord[1] for coord in coords ])
+        self.ymax = max([ coord[1] for coord in coords ])
+        self.nbrbands = max(1, len(coords) / bandsize)
+        self.bandheight = (self.ymax - self.ymin) / self.nbrbands or 1.0
+        self.bands = [ [] for i in xrange(self.nbrbands) ]
+        for i in xrange(1, len(coords)):
+            x1, y1 = coords[i-1]
+            x2, y2 = coords[i]
+            for band in xrange(self.getBand(min(y1, y2)),
+                               self.getBand(max(y1, y2)) + 1):
+                self.bands[band].append( (x1, y1, x2, y2) )
+        if numpy is not None:
+            self.arrays = [ numpy.array(edges, dtype=float).reshape(-1, 4)
+                            for edges in self.bands ]
+
+
+    def getBand(self, lat):
+        """
+        Return band number of a latitude inside the ring extent.
+        """
+
+        return min(int((lat - self.ymin) / self.bandheight), self.nbrbands-1)
+
+
+    def contains(self, lon, lat):
+        """
+        Check if point is in the ring.
+        """
+
+        if lat < self.ymin or lat > self.ymax:
+            return False
+        flg = False
+        for x1, y1, x2, y2 in self.bands[self.getBand(lat)]:
+            if (lat < y1 and lat < y2) or (lat > y1 and lat > y2):
+                continue
+            if (lat == y1 and lon == x1) or (lat == y2 and lon == x2):
+                return True
+            if (lat > y1 and lat <= y2) or (lat > y2 and lat <= y1):
+                if lon > x1 + (lat-y1) * (x2-x1) / (y2-y1):
+                    flg = not flg
+        return flg
+
+
+    def containsMany(self, lons, lats):
+        """
+        Same as contains() for numpy arrays of coordinates.
+
+        Return array of boolean.
+        """
+
+        result = numpy.zeros(len(lons), dtype=bool)
+        inext = numpy.nonzero((lats >= self.ymin) & (lats <= self.ymax))[0]
+        if not len(inext):
+            return result
+        bands = numpy.minimum(((lats[inext] - self.ymin)
+                               / self.bandheight).astype(int),
+                              self.nbrbands-1)
+        for band in numpy.unique(bands):
+            edges = self.arrays[band]
+            if not len(edges):
+                continue
+            sel = inext[bands == band]
+            px = lons[sel][:,None]
+            py = lats[sel][:,None]
+            x1, y1, x2, y2 = edges[:,0], edges[:,1], edges[:,2], edges[:,3]
+            span = ((py > y1) & (py <= y2)) | ((py > y2) & (py <= y1))
+            olderr = numpy.seterr(divide='ignore', invalid='ignore')
+            cross = span & (px > x1 + (py-y1) * (x2-x1) / (y2-y1))
+            numpy.seterr(**olderr)
+            vertex = ((px == x1) & (py == y1)) | ((px == x2) & (py == y2))
+            result[sel] = ((cross.sum(axis=1) % 2) == 1) | vertex.any(axis=1)
+        return result
+
+
+class AdminIndex:
+    """
+    Spatial index of administrative area polygons.
+
+    Polygons bounding boxes are bulk loaded into a R-tree (Sort Tile
+    Recursive), then each candidate polygon is checked with its
+    prepared rings.
+    """
+
+    def __init__(self, nodesize=16):
+        self.nodesize = nodesize
+        self.areas = []         # (level, key, name)
+        self.polygons = []      # (area number, outer, list of inner)
+        self.root = None
+
+
+    def addArea(self, key, name, level, polygons):
+        """
+        Add an area given by its list of (outer ring, list of inner rings)
+        of coordinates.
+        """
+
+        areanum = len(self.areas)
+        self.areas.append( (level, key, name) )
+        for outer, inners in polygons:
+            self.polygons.append( (areanum, PreparedRing(outer),
+                                   [ PreparedRing(ring) for ring in inners ]) )
+        self.root = None
+
+
+    def addAdmins(self, admins):
+        """
+        Add all areas of 'admins' verified with polygons (see verify_admin).
+        """
+
+        for adm in sorted(admins):
+            self.addArea(adm, admins[adm]["name"], admins[adm]["level"],
+                         admins[adm]["polygons"])
+
+
+    def build(self):
+        """
+        Build the R-tree, done on first lookup if needed.
+        """
+
+        entries = []
+        for num, (areanum, outer, inners) in enumerate(self.polygons):
+            xmin = min([ x for band in outer.bands for x, y, x2, y2 in band ])
+            xmax = max([ x for band in outer.bands for x, y, x2, y2 in band ])
+            entries.append( (xmin, xmax, outer.ymin, outer.ymax, num) )
+        if not entries:
+            self.root = (0.0, -1.0, 0.0, -1.0, [])
+            return
+        nodes = self._strpack(entries)
+        while len(nodes) > 1:
+            nodes = self._strpack(nodes)
+        self.root = nodes[0]
+
+
+    def _strpack(self, entries):
+        nbrnodes = (len(entries) + self.nodesize - 1) / self.nodesize
+        slicesize = int(math.ceil(math.sqrt(nbrnodes))) * self.nodesize
+        entries.sort(key=lambda e: e[0] + e[1])
+        nodes = []
+        for start in xrange(0, len(entries), slicesize):
+            part = sorted(entries[start:start+slicesize],
+                          key=lambda e: e[2] + e[3])
+            for pos in xrange(0, len(part), self.nodesize):
+                group = part[pos:pos+self.nodesize]
+                nodes.append( (min([ e[0] for e in group ]),
+                               max([ e[1] for e in group ]),
+                               min([ e[2] for e in group ]),
+                               max([ e[3] for e in group ]),
+                               group) )
+        return nodes
+
+
+    def _polygoncontains(self, num, lon, lat):
+        areanum, outer, inners = self.polygons[num]
+        if not outer.contains(lon, lat):
+            return False
+        for ring in inners:
+            if ring.contains(lon, lat):
+                return False
+        return True
+
+
+    def lookup(self, lon, lat):
+        """
+        Return list of (level, key, name) of areas containing the point,
+        upper levels first.
+        """
+
+        if self.root is None:
+            self.build()
+        found = set()
+        stack = [ self.root ]
+        while stack:
+            xmin, xmax, ymin, ymax, children = stack.pop()
+            if lon < xmin or lon > xmax or lat < ymin or lat > ymax:
+                continue
+            for child in children:
+                if isinstance(child[4], list):
+                    stack.append(child)
+                elif (child[0] <= lon <= child[1] and child[2] <= lat <= child[3]
+                      and self._polygoncontains(child[4], lon, lat)):
+                    found.add(self.polygons[child[4]][0])
+        return sorted([ self.areas[areanum] for areanum in found ])
+
+
+    def lookupBatch(self, points):
+        """
+        Same as lookup() for a list of (lon, lat).
+
+        Vectorized with numpy when available.
+        """
+
+        if numpy is None:
+            return [ self.lookup(lon, lat) for lon, lat in points ]
+        if self.root is None:
+            self.build()
+        coords = numpy.array(points, dtype=float).reshape(-1, 2)
+        lons = coords[:,0]
+        lats = coords[:,1]
+        found = [ set() for i in xrange(len(coords)) ]
+        valid = numpy.nonzero(~numpy.isnan(coords).any(axis=1))[0]
+        stack = [ (self.root, valid) ]
+        while stack:
+            (xmin, xmax, ymin, ymax, children), idx = stack.pop()
+            idx = idx[(lons[idx] >= xmin) & (lons[idx] <= xmax)
+                      & (lats[idx] >= ymin) & (lats[idx] <= ymax)]
+            if not len(idx):
+                continue
+            for child in children:
+                if isinstance(child[4], list):
+                    stack.append( (child, idx) )
+                    continue
+                sel = idx[(lons[idx] >= child[0]) & (lons[idx] <= child[1])
+                          & (lats[idx] >= child[2]) & (lats[idx] <= child[3])]
+                if not len(sel):
+                    continue
+                areanum, outer, inners = self.polygons[child[4]]
+                inside = outer.containsMany(lons[sel], lats[sel])
+                for ring in inners:
+                    inside &= ~ring.containsMany(lons[sel], lats[sel])
+                for i in sel[inside]:
+                    found[i].add(areanum)
+        return [ sorted([ self.areas[areanum] for areanum in areanums ])
+                 for areanums in found ]
+
+
+def load_geojson(filename, index):
+    """
+    Add to 'index' the areas of a GeoJSON file (see write_geojson).
+    """
+
+    data = json.load(open(filename))
+    for feature in data["features"]:
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            rings = [ geometry["coordinates"] ]
+        else:
+            rings = geometry["coordinates"]
+        polygons = [ ([ tuple(coord) for coord in polygon[0] ],
+                      [ [ tuple(coord) for coord in ring ]
+                        for ring in polygon[1:] ])
+                     for polygon in rings ]
+        properties = feature["properties"]
+        key = feature.get("id")
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        index.addArea(key, properties["name"].encode("utf-8"),
+                      properties["admin_level"], polygons)
+
+
+def wkb_polygons(data, pos=0):
+    """
+    Decode a WKB Polygon or MultiPolygon.
+
+    Return (list of (outer ring, list of inner rings), position after
+    the geometry).
+    """
+
+    order = "<>"[struct.unpack_from("B", data, pos)[0] == 0]
+    geomtype, = struct.unpack_from(order + "I", data, pos+1)
+    pos += 5
+    if geomtype == 6:
+        nbr, = struct.unpack_from(order + "I", data, pos)
+        pos += 4
+        polygons = []
+        for i in xrange(nbr):
+            polygon, pos = wkb_polygons(data, pos)
+            polygons.extend(polygon)
+        return (polygons, pos)
+    elif geomtype != 3:
+        raise ValueError("WKB geometry type %d not supported" % geomtype)
+    nbr, = struct.unpack_from(order + "I", data, pos)
+    pos += 4
+    rings = []
+    for i in xrange(nbr):
+        nbrpnt, = struct.unpack_from(order + "I", data, pos)
+        values = struct.unpack_from(order + "%dd" % (nbrpnt*2), data, pos+4)
+        pos += 4 + nbrpnt*16
+        rings.append(zip(values[0::2], values[1::2]))
+    return ([ (rings[0], rings[1:]) ], pos)
+
+
+def load_wkb(filename, index):
+    """
+    Add to 'index' the areas of a WKB rows file (see write_wkb).
+    """
+
+    data = open(filename, "rb").read()
+    if data[:5] != "UGWKB":
+        raise ValueError("'%s' is not a WKB export" % filename)
+    extent = ord(data[5]) & 1
+    pos = 6
+    while pos < len(data):
+        size, = struct.unpack_from("<I", data, pos)
+        row = data[pos+4:pos+4+size]
+        pos += 4 + size
+        lenkey, = struct.unpack_from("<H", row, 0)
+        key = row[2:2+lenkey]
+        lenname, = struct.unpack_from("<H", row, 2+lenkey)
+        rowpos = 4 + lenkey
+        name = row[rowpos:rowpos+lenname]
+        level = ord(row[rowpos+lenname])
+        rowpos += lenname + 1
+        if extent:
+            rowpos += 40
+        polygons, end = wkb_polygons(row, rowpos+4)
+        index.addArea(key, name, level, polygons)
+
+
+def load_areas(filename):
+    """
+    Return AdminIndex built from a GeoJSON or WKB export.
+    """
+
+    index = AdminIndex()
+    if filename.endswith(".wkb"):
+        load_wkb(filename, index)
+    else:
+        load_geojson(filename, index)
+    index.build()
+    return index
+
+
+def lookup_lines(index, lines):
+    """
+    Return the result of each input line "lon lat" (or "lon,lat"): the
+    line followed by the names of the areas, tab separated.
+    """
+
+    points = []
+    for line in lines:
+        try:
+            lon, lat = line.replace(",", " ").split()[:2]
+            points.append( (float(lon), float(lat)) )
+        except ValueError:
+            points.append( (float("nan"), float("nan")) )
+    result = []
+    for line, areas in zip(lines, index.lookupBatch(points)):
+        result.append('\t'.join([ line.rstrip("\r\n") ]
+                                + [ name for level, key, name in areas ]))
+    return result
+
+
+def lookup_stream(index, infile, outfile, batchsize=10000):
+    """
+    Read points from 'infile' and write results in 'outfile', by batch
+    of 'batchsize' points.
+
+    Return number of points.
+    """
+
+    nbr = 0
+    while True:
+        lines = []
+        for line in infile:
+            lines.append(line)
+            if len(lines) >= batchsize:
+                break
+        if not lines:
+            break
+        outfile.write('\n'.join(lookup_lines(index, lines)) + '\n')
+        nbr += len(lines)
+    outfile.flush()
+    return nbr
+
+
+class LookupHandler(SocketServer.StreamRequestHandler):
+    """
+    One request per connection: the client sends its points and closes
+    its side of the socket, the results are sent back by batch.
+    """
+
+    def handle(self):
+        lookup_stream(self.server.index, self.rfile, self.wfile,
+                      self.server.batchsize)
+
+
+def main():
+    parser = optparse.OptionParser(
+                usage="%prog [options] areas.geojson|areas.wkb [points]")
+    parser.add_option("-o", "--output",
+                      help="result file [standard output]")
+    parser.add_option("--socket", metavar="PATH",
+                      help="serve lookups on the local socket PATH")
+    parser.add_option("--batch", type="int", default=10000,
+                      help="points looked up at once [%default]")
+    (options, args) = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error("expected areas file and optional points file")
+
+    # Results may go to stdout, messages to stderr
+    logo.stdout = sys.stderr
+    logo.init(filename = uganda_config.logfile,
+              verbose = uganda_config.verbose,
+              progress = uganda_config.progress)
+    index = load_areas(args[0])
+    logo.INFO("%d areas, %d polygons loaded from '%s'",
+              len(index.areas), len(index.polygons), args[0])
+
+    if options.socket:
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        server = SocketServer.UnixStreamServer(options.socket, LookupHandler)
+        server.index = index
+        server.batchsize = options.batch
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(options.socket)
+            logo.close()
+        return
+
+    if len(args) == 2:
+        infile = open(args[1])
+    else:
+        infile = sys.stdin
+    if options.output:
+        outfile = open(options.output, "w")
+    else:
+        outfile = sys.stdout
+    nbr = lookup_stream(index, infile, outfile, options.batch)
+    outfile.close()
+    logo.INFO("%d points looked up", nbr)
+    logo.close()
+
+
+if __name__ == '__main__':
+    main()
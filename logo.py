@@ -26,6 +26,18 @@ Log file and progress status.
 """
 
 import sys, time
+import os
+import json
+import atexit
+import threading
+import Queue
+import collections
+import re
+import BaseHTTPServer
+try:
+    import resource
+except ImportError:
+    resource = None
 
 #
 # Globals
@@ -34,25 +46,59 @@ level = 0
 stdout = sys.stdout
 quiet = True
 filelog = None
+logqueue = None          # messages waiting for the writer thread
+logpending = []          # messages not yet queued
+logbatch = 256           # number of messages queued at once
+logthread = None
+logbuffer = 1<<20        # log file buffer size
 inprogress = ''   # '\n' when stdout is not on the first column
 progressmax = 0
 progresstext = ''
 progressnext = 0
 progresstimer = 0.0
 progresscpt = 0
+progresslast = 0.0       # time of the last display
+progressinterval = 0.5   # minimum seconds between two displays
+counters = {}            # name -> value, see count()
+phases = []              # finished phases for the run report
+phasestart = None        # (text, wall, cpu, counters) of the current phase
+runstart = (time.time(), 0.0)
+tracebuffer = None       # last spans (name, start, end, thread, args)
+tracing = False          # spans are recorded, see trace()
+metrics = {}             # name -> [type, help, {labels: value}, buckets]
+metricslock = threading.Lock()
+metricsprefix = "uganda_"
+metricsserver = None     # HTTP server and its thread, see serveMetrics()
 
 
 #
 # Functions
 #
 
-def WARN(text):
+def _format(text, args):
+    """
+    Return the message 'text' formatted with 'args' (a single dictionary
+    is used for named fields).
+    """
+
+    if args:
+        if len(args) == 1 and isinstance(args[0], dict):
+            text = text % args[0]
+        else:
+            text = text % args
+    return text
+
+
+def WARN(text, *args):
     """
     Write a warning message to stdout and the log file.
     """
 
     global inprogress
 
+    if quiet and not filelog:
+        return
+    text = _format(text, args)
     if text[-1] == '\n':
         text = "WARN: " + text
     else:
@@ -62,10 +108,10 @@ def WARN(text):
         stdout.flush()
         inprogress = ''
     if filelog:
-        filelog.write(text)
+        _logput(text)
 
 
-def ERROR(text):
+def ERROR(text, *args):
     """
     Write an error message to stdout and the log file.
     Return an Exception object so the caller can raise it.
@@ -73,6 +119,7 @@ def ERROR(text):
 
     global inprogress
 
+    text = _format(text, args)
     inst = Exception(text)
     if text[-1] == '\n':
         text = "ERROR: " + text
@@ -83,11 +130,11 @@ def ERROR(text):
         stdout.flush()
         inprogress = ''
     if filelog:
-        filelog.write(text)
+        _logput(text)
     return inst
 
 
-def INFO(text):
+def INFO(text, *args):
     """
     Write an information message to stdout + log file.
     No message is printed if 'level' is below 1.
@@ -95,30 +142,67 @@ def INFO(text):
 
     global inprogress
 
+    if level < 1 or (quiet and not filelog):
+        return
+    text = _format(text, args)
     if text[-1] == '\n':
         text = "INFO: " + text
     else:
         text = "INFO: " + text + "\n"
-    if not quiet and level >= 1:
+    if not quiet:
         stdout.write(inprogress + text)
         stdout.flush()
         inprogress = ''
-    if filelog and level >= 1:
-        filelog.write(text)
+    if filelog:
+        _logput(text)
 
 
-def DEBUG(text):
+def DEBUG(text, *args):
     """
     Write a debug message to log file only.
     No message is printed if 'level' is below 2.
+
+    The message is only formatted with 'args' when it is written.
     """
 
+    if level < 2 or not filelog:
+        return
+    if args:
+        text = _format(text, args)
     if text[-1] == '\n':
-        text = "DEBUG: " + text
+        _logput("DEBUG: " + text)
     else:
-        text = "DEBUG: " + text + "\n"
-    if filelog and level >= 2:
-        filelog.write(text)
+        _logput("DEBUG: " + text + "\n")
+
+
+def _logput(text):
+    """
+    Add a message for the log file, messages are given to the writer
+    thread by batch of 'logbatch'.
+    """
+
+    global logpending
+
+    logpending.append(text)
+    if len(logpending) >= logbatch:
+        logqueue.put(logpending)
+        logpending = []
+
+
+def _logwriter(logfile, messages):
+    """
+    Background thread writing the batches of messages of the queue to
+    the log file, until None is received.
+    """
+
+    while True:
+        batch = messages.get()
+        try:
+            if batch is None:
+                break
+            logfile.writelines(batch)
+        finally:
+            messages.task_done()
 
 
 def init(filename=None, verbose=0, progress=True, title=''):
@@ -127,17 +211,24 @@ def init(filename=None, verbose=0, progress=True, title=''):
 
     Messages will be added to the file (append mode), 'verbose' controls
     the log level and 'progress' flag the use of stdout for monitoring.
+    The file is written by a background thread with a large buffer.
     """
 
-    global filelog, level, quiet, inprogress
+    global filelog, level, quiet, inprogress, logqueue, logthread, runstart
 
     if filename:
-        filelog = open(filename, "a")
+        filelog = open(filename, "a", logbuffer)
+        logqueue = Queue.Queue()
+        logthread = threading.Thread(target=_logwriter,
+                                     args=(filelog, logqueue))
+        logthread.daemon = True
+        logthread.start()
     else:
         filelog = None
     level = int(verbose)
     quiet = not progress
     inprogress = ''
+    runstart = (time.time(), _cputime())
     if filelog:
         title = title.strip()
         if title:
@@ -146,7 +237,42 @@ def init(filename=None, verbose=0, progress=True, title=''):
             text = "Start"
         msg = [ time.strftime("%Y.%m.%d %H.%M.%S:", time.localtime()),
                 "*" * 7, text, "*" * 7 ]
-        filelog.write(' '.join(msg) + '\n')
+        _logput(' '.join(msg) + '\n')
+
+
+def flush():
+    """
+    Write pending messages to the log file (needed before a fork).
+    """
+
+    global logpending
+
+    if filelog:
+        logqueue.put(logpending)
+        logpending = []
+        logqueue.join()
+        filelog.flush()
+    stdout.flush()
+
+
+def detach():
+    """
+    Stop all output, used in worker processes (messages are discarded).
+    """
+
+    global filelog, quiet, progress, logqueue, logthread, logpending
+    global metricsserver
+
+    filelog = None
+    logqueue = None
+    logthread = None
+    logpending = []
+    quiet = True
+    progress = _noprogress
+    if metricsserver is not None:
+        # Only the socket is inherited, the thread serving it is not
+        metricsserver[0].socket.close()
+        metricsserver = None
 
 
 def close(title=''):
@@ -154,7 +280,7 @@ def close(title=''):
     Close the log file.
     """
 
-    global filelog
+    global filelog, logqueue, logthread, logpending
 
     if filelog:
         title = title.strip()
@@ -164,9 +290,27 @@ def close(title=''):
             text = "Done"
         msg = [ time.strftime("%Y.%m.%d %H.%M.%S:", time.localtime()),
                 "*" * 7, text, "*" * 7 ]
-        filelog.write(' '.join(msg) + '\n')
+        logpending.append(' '.join(msg) + '\n')
+        logqueue.put(logpending)
+        logqueue.put(None)
+        logthread.join()
         filelog.close()
     filelog = None
+    logqueue = None
+    logthread = None
+    logpending = []
+
+
+def _atexit():
+    """
+    Write pending messages when the program stops without close().
+    """
+
+    if filelog and logthread.is_alive():
+        flush()
+
+
+atexit.register(_atexit)
 
 
 def starting(text, nb):
@@ -177,38 +321,84 @@ def starting(text, nb):
     A timer is also started.
     """
 
-    global inprogress, progresstext, progressmax
-    global progressnext, progresstimer, progresscpt
+    global inprogress, progresstext, progressmax, progress
+    global progressnext, progresstimer, progresscpt, progresslast, phasestart
 
+    phasestart = (text, time.time(), _cputime(), dict(counters))
     if not quiet:
         stdout.write(inprogress + text + ' 0%')
         stdout.flush()
         inprogress = '\n'
         if nb > 0:
             progressmax = nb
-        progressnext = int(progressmax/100.0)
+        progressnext = 1
         progresstext = '\r' + text + ' '
         progresstimer = time.time()
+        progresslast = progresstimer
         progresscpt = 0
+        if progressmax:
+            progress = _progress
+
+
+def _noprogress(num=None):
+    """
+    Progress meter not displayed (quiet or no meter started).
+    """
+
+    pass
 
 
-def progress(num=None):
+def _progress(num=None):
     """
     Display loop progress, 100% is reached when 'num' is equal to 'nb'.
+
+    Without 'num', each call counts for one item. Calls are only counted
+    until the next check of the clock (see _showprogress).
+    """
+
+    global progresscpt
+
+    if num is None:
+        progresscpt += 1
+        num = progresscpt
+    if num >= progressnext:
+        _showprogress(num)
+
+
+def _showprogress(num):
+    """
+    Display percent, throughput and remaining time at most every
+    'progressinterval' seconds.
+
+    The next clock check is scheduled from the throughput, the number
+    of items between two checks only doubles at the start.
     """
 
-    global inprogress, progressnext, progresscpt
+    global progressnext, progresslast, inprogress
 
-    if not quiet and progressmax:
-        if num is None:
-            progresscpt += 1
-            num = progresscpt
-        if num > progressnext < progressmax:
-            num = int(100.0*num/progressmax)
-            stdout.write(progresstext + str(num) + '%')
-            stdout.flush()
-            progressnext = int((num+1)*progressmax/100.0)
-            inprogress = '\n'
+    now = time.time()
+    elapsed = now - progresstimer
+    rate = 0.0
+    if elapsed > 0:
+        rate = num / elapsed
+    progressnext = num + max(1, min(int(rate*progressinterval), num+1))
+    if now - progresslast < progressinterval:
+        return
+    progresslast = now
+
+    percent = min(100, int(100.0*num/progressmax))
+    text = progresstext + str(percent) + '%'
+    if rate:
+        text += ' %d/s' % rate
+        if num < progressmax:
+            remain = (progressmax - num) / rate
+            text += ' ETA %dmin%02ds' % (int(remain/60), int(remain%60))
+    stdout.write(text + '   ')
+    stdout.flush()
+    inprogress = '\n'
+
+
+progress = _noprogress
 
 
 def ending():
@@ -216,12 +406,367 @@ def ending():
     Stop progression meter and display elapsed time.
     """
 
-    global progressmax, inprogress
-
-    progressmax = 0
+    global progressmax, inprogress, progress, phasestart
+
+    if phasestart is not None:
+        text, wall, cpu, startcounters = phasestart
+        phase = { "name" : text,
+                  "wall" : round(time.time() - wall, 3),
+                  "cpu" : round(_cputime() - cpu, 3),
+                  "maxrss_kb" : _maxrss(),
+                  "counters" : {} }
+        for name, value in counters.iteritems():
+            if value != startcounters.get(name, 0):
+                phase["counters"][name] = value - startcounters.get(name, 0)
+        phases.append(phase)
+        if tracebuffer is not None:
+            tracebuffer.append( (text, wall, time.time(), None, None) )
+        gauge("phase_seconds", phase["wall"], "Duration of the phase",
+              phase=text)
+        phasestart = None
     if not quiet:
         stdout.write(progresstext + '100%')
-        stdout.flush()
         elapsed = time.time() - progresstimer
-        stdout.write(" (%dmin%02ds)\n" % (int(elapsed/60), int(elapsed%60)))
+        text = " (%dmin%02ds" % (int(elapsed/60), int(elapsed%60))
+        if elapsed > 0 and progressmax:
+            text += ", %d/s" % (progressmax / elapsed)
+        stdout.write(text + ")              \n")
+        stdout.flush()
         inprogress = ''
+    progressmax = 0
+    progress = _noprogress
+
+
+def count(name, value=1):
+    """
+    Add 'value' to the counter 'name' (counters are given by phase in
+    the run report).
+    """
+
+    counters[name] = counters.get(name, 0) + value
+
+
+def _cputime():
+    """
+    Return CPU time (user + system) of the process and its finished
+    children (workers).
+    """
+
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def _maxrss():
+    """
+    Return peak resident memory (kB) of the process or of its biggest
+    child.
+    """
+
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def writeReport(filename):
+    """
+    Write the run report in JSON: total and per phase (started by
+    starting()) wall time, CPU time, peak memory and counters.
+    """
+
+    report = { "start" : time.strftime("%Y-%m-%dT%H:%M:%S",
+                                       time.localtime(runstart[0])),
+               "wall" : round(time.time() - runstart[0], 3),
+               "cpu" : round(_cputime() - runstart[1], 3),
+               "maxrss_kb" : _maxrss(),
+               "phases" : phases,
+               "counters" : counters }
+    out = open(filename, "w")
+    json.dump(report, out, indent=1, sort_keys=True)
+    out.write("\n")
+    out.close()
+
+
+class _Span:
+    """
+    Record the time spent in a 'with' block, see span().
+    """
+
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, exctype, excvalue, traceback):
+        tracebuffer.append( (self.name, self.start, time.time(), None,
+                             self.args) )
+        return False
+
+
+class _NoSpan:
+    """
+    Span when tracing is not enabled, does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exctype, excvalue, traceback):
+        return False
+
+
+_nospan = _NoSpan()
+
+
+def trace(maxspans=1000000):
+    """
+    Enable tracing, only the last 'maxspans' spans are kept.
+    """
+
+    global tracebuffer, tracing
+
+    tracebuffer = collections.deque(maxlen=maxspans)
+    tracing = True
+
+
+def span(name, **args):
+    """
+    Return a context manager recording the time spent in a 'with' block
+    as a span named 'name' with 'args' (shown in the trace viewer).
+    Phases (see starting) are also recorded as spans.
+    """
+
+    if tracebuffer is None:
+        return _nospan
+    return _Span(name, args)
+
+
+def addSpan(name, start, end, thread=None, **args):
+    """
+    Record a span measured elsewhere (for example in a worker process,
+    'thread' is then its pid).
+    """
+
+    if tracebuffer is not None:
+        tracebuffer.append( (name, start, end, thread, args) )
+
+
+def writeTrace(filename):
+    """
+    Write the spans recorded in the Chrome trace event format (JSON),
+    viewable in chrome://tracing or Perfetto.
+    """
+
+    pid = os.getpid()
+    events = []
+    if tracebuffer:
+        origin = min([ start for name, start, end, thread, args
+                       in tracebuffer ])
+        for name, start, end, thread, args in tracebuffer:
+            event = { "name" : name, "ph" : "X", "pid" : pid,
+                      "tid" : thread or pid,
+                      "ts" : round((start - origin) * 1000000, 1),
+                      "dur" : round((end - start) * 1000000, 1) }
+            if args:
+                event["args"] = args
+            events.append(event)
+    out = open(filename, "w")
+    json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, out)
+    out.write("\n")
+    out.close()
+
+
+def _setmetric(name, mtype, helptext, labels, buckets=None):
+    """
+    Return values of a metric for its labels, creating it if needed.
+    """
+
+    if name not in metrics:
+        metrics[name] = [ mtype, helptext, {}, buckets ]
+    return metrics[name][2], tuple(sorted(labels.items()))
+
+
+def gauge(name, value, helptext='', **labels):
+    """
+    Set the gauge 'name' (with 'labels') to 'value'.
+    """
+
+    with metricslock:
+        values, key = _setmetric(name, "gauge", helptext, labels)
+        values[key] = value
+
+
+def counter(name, value=1, helptext='', **labels):
+    """
+    Add 'value' to the counter 'name' (with 'labels').
+
+    Run counters (see count) are also exported as counters, this one
+    is for values not in the run report.
+    """
+
+    with metricslock:
+        values, key = _setmetric(name, "counter", helptext, labels)
+        values[key] = values.get(key, 0) + value
+
+
+def observe(name, value, helptext='',
+            buckets=(0.001, 0.01, 0.1, 1, 10, 60, 600), **labels):
+    """
+    Add 'value' to the histogram 'name' (with 'labels').
+    """
+
+    with metricslock:
+        values, key = _setmetric(name, "histogram", helptext, labels,
+                                 buckets)
+        if key not in values:
+            values[key] = [ [0] * len(buckets), 0.0, 0 ]
+        histogram = values[key]
+        for i, bound in enumerate(metrics[name][3]):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def _labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join([ '%s="%s"' % (label, str(value)
+                                            .replace('\\', '\\\\')
+                                            .replace('"', '\\"')
+                                            .replace('\n', '\\n'))
+                               for label, value in items ])
+
+
+def declare(name, mtype, helptext=''):
+    """
+    Declare the metric 'name' of type 'mtype' before any value is
+    given, a counter starts at 0 so it is exported even if it never
+    happens.
+
+    Run counters (see count) are declared with their exported name
+    (spaces replaced by '_', with a '_total' suffix).
+    """
+
+    with metricslock:
+        values, key = _setmetric(name, mtype, helptext, {})
+        if mtype == "counter":
+            values.setdefault(key, 0)
+
+
+def formatMetrics():
+    """
+    Return the metrics and the run counters in the Prometheus text
+    format.
+    """
+
+    lines = []
+    with metricslock:
+        allmetrics = dict(metrics)
+        for name, value in counters.items():
+            metricname = re.sub("[^a-zA-Z0-9]+", "_", name).strip("_")
+            metricname += "_total"
+            helptext = "Run counter '%s'" % name
+            if metricname in metrics:
+                helptext = metrics[metricname][1]
+            allmetrics[metricname] = [ "counter", helptext,
+                                       { () : value }, None ]
+        for name in sorted(allmetrics):
+            mtype, helptext, values, buckets = allmetrics[name]
+            fullname = metricsprefix + name
+            if helptext:
+                lines.append("# HELP %s %s" % (fullname, helptext))
+            lines.append("# TYPE %s %s" % (fullname, mtype))
+            for key in sorted(values):
+                if mtype != "histogram":
+                    lines.append("%s%s %s" % (fullname, _labels(key),
+                                              repr(values[key])))
+                    continue
+                bucketcounts, total, nbr = values[key]
+                for bound, nbrbound in zip(buckets, bucketcounts):
+                    lines.append("%s_bucket%s %d" % (fullname,
+                                 _labels(key, [ ("le", repr(bound)) ]),
+                                 nbrbound))
+                lines.append("%s_bucket%s %d" % (fullname,
+                             _labels(key, [ ("le", "+Inf") ]), nbr))
+                lines.append("%s_sum%s %s" % (fullname, _labels(key),
+                                              repr(total)))
+                lines.append("%s_count%s %d" % (fullname, _labels(key), nbr))
+    return '\n'.join(lines) + '\n'
+
+
+def writeMetrics(filename):
+    """
+    Write the metrics for the textfile collector of node_exporter, the
+    file is replaced at once (rename).
+    """
+
+    out = open(filename + ".tmp", "w")
+    out.write(formatMetrics())
+    out.close()
+    os.rename(filename + ".tmp", filename)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer any GET with the metrics.
+    """
+
+    def do_GET(self):
+        data = formatMetrics()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, fmt, *args):
+        pass    # not from this thread, the log is not thread safe
+
+
+def serveMetrics(port, host="127.0.0.1"):
+    """
+    Serve the metrics over HTTP on 'host':'port' from a background
+    thread, until waitMetrics() is interrupted.
+
+    Worker processes close their copy of the socket (see detach).
+    """
+
+    global metricsserver
+
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    metricsserver = (server, thread)
+
+
+def waitMetrics():
+    """
+    Keep serving the metrics (see serveMetrics) until interrupted, then
+    stop the server.
+    """
+
+    global metricsserver
+
+    if metricsserver is None:
+        return
+    server, thread = metricsserver
+    try:
+        while thread.is_alive():
+            thread.join(1.0)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    server.server_close()
+    metricsserver = None
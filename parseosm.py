@@ -67,6 +67,10 @@ def parse_xml(xml):
         extracted_data[typobj][idobj] = objdata
 
 
+def clear():
+    for typobj in extracted_data:
+        extracted_data[typobj].clear()
+
 def getNbRelation():
     return len(extracted_data['relation'])
 
@@ -25,6 +25,9 @@
 Construct a multi-polygon from a bunch of lines.
 """
 
+import time
+import math
+
 class FindClosedRings:
     """
     Group lines in closed rings.
@@ -36,17 +39,35 @@ class FindClosedRings:
 
     RING_CONNECT_BEGIN, RING_CONNECT_END, RING_CONNECT_FIRST = range(3)
 
-    def __init__(self, backend, lines):
+    def __init__(self, backend, lines, cache=None, maxattempts=0, maxtime=0):
         """
         Construct rings for a multipolygon from the list of unordered lines.
         The 'backend' must provide the following methods :
         - getLineEnds(lineid) = return first and last point in line
         - getLineCoords(lineid) = return all points in line
         - isRingValid(points) = is ordered list of points a valid ring
+
+        An optional 'cache' (RingCache) shared between several instances
+        replaces the backend for line geometry and ring validation.
+        The search is bounded by 'maxattempts' ring assembly and 'maxtime'
+        seconds (0 = no limit), past the budget no more backtrack is done
+        and the lines of an invalid ring are discarded.
         """
 
-        self.backend = backend
+        if cache is not None:
+            self.backend = cache
+        else:
+            self.backend = backend
+        self.cache = cache
+        self.maxattempts = maxattempts
+        self.maxtime = maxtime
+        self.nbrattempts = 0
+        self.nbrbacktracks = 0
+        self.nbrchecks = 0
+        self.exhausted = False
+        self.timestart = time.time()
         self.findclosedrings(lines)
+        self.elapsed = time.time() - self.timestart
 
 
     def findclosedrings(self, lines):
@@ -81,10 +102,11 @@ class FindClosedRings:
         self.newring = True
         while True:
             if self.assemble_ring():
+                self.nbrattempts += 1
                 if self.ringend1 == self.ringend2:
                     # Ring is closed, get geometry and check validity
                     points = self.build_geometry_ring()
-                    if self.backend.isRingValid(points):
+                    if self.is_ring_valid(points):
                         # Even if the ring is valid, do not save the geometry
                         # we will backtrack and build another ring association
                         # if the whole multipolygon is invalid
@@ -104,6 +126,17 @@ class FindClosedRings:
         return
 
 
+    def is_ring_valid(self, points):
+        """
+        Check the geometry of the ring currently built.
+        """
+
+        self.nbrchecks += 1
+        if self.cache is not None:
+            return self.cache.isRingValid(points, self.getLineRing())
+        return self.backend.isRingValid(points)
+
+
     def start_new_ring(self):
         """
         Pick a line and start building a new ring.
@@ -192,6 +225,14 @@ class FindClosedRings:
             # No more backtrack
             return False
 
+        if self.exhausted or (self.maxattempts
+                              and self.nbrattempts >= self.maxattempts) or (
+           self.maxtime and time.time() - self.timestart >= self.maxtime):
+            # Search budget exceeded, give up
+            self.exhausted = True
+            return False
+
+        self.nbrbacktracks += 1
         goback = self.backstack.pop()
         while len(self.lineconnect) > goback:
             # Restore ring status and unconsume line
@@ -225,7 +266,7 @@ class FindClosedRings:
             if dirjonction == self.RING_CONNECT_FIRST:
                 break
 
-        self.backstack = filter(lambda x: x < len(self.lineconnect()),
+        self.backstack = filter(lambda x: x < len(self.lineconnect),
                                 self.backstack)
         self.newring = True
 
@@ -256,6 +297,24 @@ class FindClosedRings:
         return points
 
 
+    def getStats(self):
+        """
+        Return counters of the search for rings.
+
+        Dictionary with number of 'attempts' (ring assembled), 'backtracks',
+        'checks' (ring validity), 'start' time, 'elapsed' time in seconds
+        and 'exhausted' flag if the search budget was exceeded.
+        """
+
+        return { "attempts" : self.nbrattempts,
+                 "backtracks" : self.nbrbacktracks,
+                 "checks" : self.nbrchecks,
+                 "start" : self.timestart,
+                 "elapsed" : self.elapsed,
+                 "exhausted" : self.exhausted,
+               }
+
+
     def getLineDiscarded(self):
         """
         Return list of lines ID not in a ring.
@@ -304,6 +363,17 @@ class FindClosedRings:
         return self.polygonring.iteritems()
 
 
+    def getCoordRing(self, ringnum):
+        """
+        Return geometry (ordered list of coordinates) for a ring.
+
+        Same as build_geometry_ring() but from the coordinates cached
+        when grouping rings.
+        """
+
+        return self.coordrings[ringnum]
+
+
     def getExtentRing(self, ringnum):
         """
         Return bounding box for a ring.
@@ -321,7 +391,7 @@ class FindClosedRings:
 
         self.polygonring = {}
         nbr = self.nbrRing()
-        coordrings = []
+        self.coordrings = []
         self.bboxrings = []
 
         # List relationship for a ring
@@ -332,7 +402,7 @@ class FindClosedRings:
         for ring in xrange(nbr):
             # Get coordinates of each ring
             coords = self.build_geometry_ring(ring)
-            coordrings.append(coords)
+            self.coordrings.append(coords)
 
             # Ring bounding box
             xmin = min(coords, key=lambda a: a[0])[0]
@@ -354,7 +424,7 @@ class FindClosedRings:
                   or ymin2 < ymin1 or ymax2 > ymax1):
                     continue
 
-                if ringcontains(coordrings[i], coordrings[j]):
+                if ringcontains(self.coordrings[i], self.coordrings[j]):
                     containedby[j].append(i)
 
         # Group ring, find top most ring (parent) and its immediate child
@@ -385,6 +455,141 @@ class FindClosedRings:
                         ringstack.remove(inner)
 
 
+class RingCache:
+    """
+    Share line geometry and ring validation between FindClosedRings.
+
+    Admin areas are verified from the lowest level (leaf) up to the top
+    level, the rings of an upper level being made of lines already seen
+    in the rings of its children.  A ring built only with lines coming from
+    valid rings is not fully revalidated, only pair of lines never seen
+    together in a valid ring are checked for crossing (shared-boundary
+    junctions between children).
+    The 'backend' must provide the methods needed by FindClosedRings and :
+    - isLineCrossing(points1, points2) = do both lines cross each other
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lineends = {}       # lineid -> (first point, last point)
+        self.linecoords = {}     # lineid -> list of coordinates
+        self.linebbox = {}       # lineid -> (xmin, xmax, ymin, ymax)
+        self.lineinring = {}     # lineid -> set of valid ring number
+        self.ringvalid = {}      # frozenset of lineid -> valid or not
+        self.nbrvalid = 0
+
+
+    def getLineEnds(self, lineid):
+        """
+        Return first and last point in line (cached).
+        """
+
+        try:
+            return self.lineends[lineid]
+        except KeyError:
+            points = self.backend.getLineEnds(lineid)
+            self.lineends[lineid] = points
+            return points
+
+
+    def getLineCoords(self, lineid):
+        """
+        Return a copy of all points in line (cached).
+        """
+
+        try:
+            return list(self.linecoords[lineid])
+        except KeyError:
+            coords = self.backend.getLineCoords(lineid)
+            self.linecoords[lineid] = tuple(coords)
+            return list(coords)
+
+
+    def getExtentLine(self, lineid):
+        """
+        Return bounding box for a line.
+
+        Return (xmin, xmax, ymin, ymax).
+        """
+
+        try:
+            return self.linebbox[lineid]
+        except KeyError:
+            coords = self.getLineCoords(lineid)
+            bbox = ( min([ x for x, y in coords ]),
+                     max([ x for x, y in coords ]),
+                     min([ y for x, y in coords ]),
+                     max([ y for x, y in coords ]) )
+            self.linebbox[lineid] = bbox
+            return bbox
+
+
+    def isRingValid(self, points, lines):
+        """
+        Check if ring (ordered list of points made by 'lines') is valid.
+
+        Remember the result, a valid ring validate all its pair of lines.
+        """
+
+        key = frozenset(lines)
+        if key in self.ringvalid:
+            return self.ringvalid[key]
+
+        if points[0] != points[-1]:
+            valid = False
+        elif len(set(points)) < len(points)-1:
+            valid = False
+        elif [ lineid for lineid in key if lineid not in self.lineinring ]:
+            # Some lines never checked, do it the hard way
+            valid = self.backend.isRingValid(points)
+        else:
+            valid = self.isJunctionValid(list(key))
+
+        self.ringvalid[key] = valid
+        if valid:
+            self.nbrvalid += 1
+            for lineid in key:
+                self.lineinring.setdefault(lineid, set()).add(self.nbrvalid)
+        return valid
+
+
+    def addValidRing(self, lines):
+        """
+        Record a ring validated elsewhere (by another cache).
+        """
+
+        key = frozenset(lines)
+        if self.ringvalid.get(key):
+            return
+        self.ringvalid[key] = True
+        self.nbrvalid += 1
+        for lineid in key:
+            self.lineinring.setdefault(lineid, set()).add(self.nbrvalid)
+
+
+    def isJunctionValid(self, lines):
+        """
+        Check crossing between pair of lines not already validated together.
+        """
+
+        for i in xrange(len(lines)):
+            line1 = lines[i]
+            for j in xrange(i+1, len(lines)):
+                line2 = lines[j]
+                if not self.lineinring[line1].isdisjoint(
+                                                    self.lineinring[line2]):
+                    continue   # already in the same valid ring
+                xmin1, xmax1, ymin1, ymax1 = self.getExtentLine(line1)
+                xmin2, xmax2, ymin2, ymax2 = self.getExtentLine(line2)
+                if (xmin2 > xmax1 or xmax2 < xmin1
+                  or ymin2 > ymax1 or ymax2 < ymin1):
+                    continue
+                if self.backend.isLineCrossing(self.getLineCoords(line1),
+                                               self.getLineCoords(line2)):
+                    return False
+        return True
+
+
 def ringcontains(ring1, ring2):
     """
     Check if coordinates in ring2 are contained in ring1.
@@ -408,3 +613,19 @@ def ringcontains(ring1, ring2):
             # At least 1 point out
             return False
     return True
+
+
+def ringarea(coords, radius=6378137.0):
+    """
+    Return area of a ring on a sphere (square meters), positive when the
+    ring is counter clockwise.
+    """
+
+    area = 0.0
+    for i in xrange(1, len(coords)):
+        lon1, lat1 = coords[i-1]
+        lon2, lat2 = coords[i]
+        area += (math.radians(lon1 - lon2)
+                 * (2 + math.sin(math.radians(lat1))
+                      + math.sin(math.radians(lat2))))
+    return area * radius * radius / 2
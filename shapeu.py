@@ -63,6 +63,8 @@ class ShapeUtil:
         self.line_count = 0
         self.cachemem = mem                   # nb object max in memory
         self.glue_nearest = {}
+        self.nbr_glued = 0                    # see flushCounts
+        self.nbr_deduplicated = 0
 
 
     def roundCoord(self, lon, lat):
@@ -75,15 +77,31 @@ class ShapeUtil:
         if key in self.point_pos:
             return key
         if key in self.glue_nearest:
+            self.nbr_glued += 1
             return self.glue_nearest[key]
         for dlon, dlat in testnearest:
             gluedkey = ( round(lon+dlon, precision), round(lat+dlat, precision) )
             if gluedkey in self.point_pos:
                 self.glue_nearest[key] = gluedkey
+                self.nbr_glued += 1
                 return gluedkey
         return key
 
 
+    def flushCounts(self):
+        """
+        Add the points glued and segments deduplicated since the last call
+        to the run counters (counted here, not on each point).
+        """
+
+        if self.nbr_glued:
+            logo.count("points glued", self.nbr_glued)
+        if self.nbr_deduplicated:
+            logo.count("segments deduplicated", self.nbr_deduplicated)
+        self.nbr_glued = 0
+        self.nbr_deduplicated = 0
+
+
     def makeSegment(self, lon1, lat1, lon2, lat2):
         """
         Find if point coordinates and segment have already been seen.
@@ -94,6 +112,15 @@ class ShapeUtil:
 
         key1 = self.roundCoord(lon1, lat1)
         key2 = self.roundCoord(lon2, lat2)
+        return self.makeSegmentRounded(key1, key2)
+
+
+    def makeSegmentRounded(self, key1, key2):
+        """
+        Same as makeSegment() with coordinates already rounded
+        (see roundCoord).
+        """
+
         if key1 > key2:
             key1, key2 = key2, key1
 
@@ -122,6 +149,7 @@ class ShapeUtil:
 
             # There is only 1 intersection, our unique segment id
             for segmentid in set1.intersection(set2):
+                self.nbr_deduplicated += 1
                 return segmentid
 
         # Create a segment and point id (segment id + end selection)
@@ -157,6 +185,41 @@ class ShapeUtil:
         return segmentnum
 
 
+    def addLine(self, coords):
+        """
+        Create points and segments for a polyline given as (lon, lat) pairs.
+        Each coordinate is rounded only once.
+
+        Return the rounded coordinates as a flat array (lon, lat, ...), this
+        is the stable way to find a point after simplification (point ids
+        are renumbered), see getPointRounded().
+        """
+
+        rounded = array.array('d')
+        key1 = None
+        for lon, lat in coords:
+            key2 = self.roundCoord(lon, lat)
+            if key1 is not None:
+                self.makeSegmentRounded(key1, key2)
+            rounded.extend(key2)
+            key1 = key2
+        return rounded
+
+
+    def addRing(self, coords):
+        """
+        Same as addLine() for a ring, the ring is closed if needed.
+        """
+
+        rounded = self.addLine(coords)
+        if len(rounded) > 2 and rounded[0:2] != rounded[-2:]:
+            key1 = ( rounded[-2], rounded[-1] )
+            key2 = ( rounded[0], rounded[1] )
+            self.makeSegmentRounded(key1, key2)
+            rounded.extend(key2)
+        return rounded
+
+
     def getPoint(self, lon, lat):
         """
         Find the already existing point.
@@ -169,6 +232,16 @@ class ShapeUtil:
         return None
 
 
+    def getPointRounded(self, key):
+        """
+        Find the already existing point from coordinates already rounded
+        (see roundCoord).
+        Return the id of the point or None if doesn't exist.
+        """
+
+        return self.point_pos.get(key)
+
+
     def getSegment(self, pointid1, pointid2):
         """
         Find the already existing segment linking 2 points.
@@ -235,6 +308,23 @@ class ShapeUtil:
         return coords
 
 
+    def getLinePoints(self, lineid):
+        """
+        Get array of all point ids in a line.
+        """
+
+        idx = (lineid-1)*2
+        segmentdir1 = self.line_ends[idx]
+        segmentdir2 = self.line_ends[idx+1]
+        pointids = array.array('i',
+                               (self.point_pos[self.coord_pnt[segmentdir1]],))
+        while segmentdir1^1 != segmentdir2:
+            segmentdir1 = self.segment_connect[segmentdir1^1]
+            pointids.append(self.point_pos[self.coord_pnt[segmentdir1]])
+        pointids.append(self.point_pos[self.coord_pnt[segmentdir2]])
+        return pointids
+
+
     def iterPoints(self):
         """
         Generator function on pointid and coordinates.
@@ -252,18 +342,11 @@ class ShapeUtil:
 
     def iterLines(self):
         """
-        Generator function on lineid and list of pointid.
+        Generator function on lineid and array of pointid.
         """
 
-        for lineid in xrange(self.line_count):
-            segmentdir1 = self.line_ends[lineid*2]
-            segmentdir2 = self.line_ends[lineid*2+1]
-            pointids = [ self.point_pos[self.coord_pnt[segmentdir1]] ]
-            while segmentdir1^1 != segmentdir2:
-                segmentdir1 = self.segment_connect[segmentdir1^1]
-                pointids.append(self.point_pos[self.coord_pnt[segmentdir1]])
-            pointids.append(self.point_pos[self.coord_pnt[segmentdir2]])
-            yield lineid+1, pointids
+        for lineid in xrange(1, self.line_count+1):
+            yield lineid, self.getLinePoints(lineid)
         return
 
 
@@ -282,8 +365,8 @@ class ShapeUtil:
         nodes per way).
         """
 
-        logo.DEBUG("Before simplification %d points, %d segments" % (
-                   len(self.point_pos), self.segment_count/2))
+        logo.DEBUG("Before simplification %d points, %d segments",
+                   len(self.point_pos), self.segment_count/2)
         logo.starting("Line simplification", self.segment_count)
         self.line_seg = array.array('i', [0] * (self.cachemem/2))
         self.line_ends = array.array('i')
@@ -298,7 +381,7 @@ class ShapeUtil:
             if coordpts is None:
                 # Orphaned segment, happens when a point is simplified
                 continue
-            self._simplifyLineSegment(coordpts, specialjoinset)
+            self._simplifyLine(coordpts, specialjoinset)
         logo.ending()
 
         # Special case for merged segment (duplicate segment removed)
@@ -316,7 +399,7 @@ class ShapeUtil:
                 except ValueError:
                     continue
                 coordpts = self._buildLineFromSegment(segmentnum, lineid)
-                self._simplifyLineSegment(coordpts, newjoinset)
+                self._simplifyLine(coordpts, newjoinset)
             logo.ending()
             specialjoinset = newjoinset
 
@@ -365,8 +448,8 @@ class ShapeUtil:
                 segmentnum = segmentnum^1
             self.line_ends.append(segmentnum)
         logo.ending()
-        logo.DEBUG("After simplification %d points, %d lines" % (
-                   len(self.point_pos), self.line_count))
+        logo.DEBUG("After simplification %d points, %d lines",
+                   len(self.point_pos), self.line_count)
 
 
     def _buildLineFromSegment(self, segmentnum, lineid=0):
@@ -405,11 +488,30 @@ class ShapeUtil:
         return coordpts
 
 
+    def _simplifyLine(self, coordpts, specialjoinset):
+        """
+        Simplify a line, in a span of its own when tracing.
+        """
+
+        if logo.tracing:
+            with logo.span("simplify line", points=len(coordpts)):
+                self._simplifyLineSegment(coordpts, specialjoinset)
+        else:
+            self._simplifyLineSegment(coordpts, specialjoinset)
+
+
     def _simplifyLineSegment(self, coordpts, specialjoinset):
             # Find useless points
             coordpts, purgepts = simplifyPoints(coordpts)
+            nbrpurge = len(purgepts)
+            logo.count("points removed by simplifyPoints", nbrpurge)
             coordpts, purgepts = simplifyShapeZV(coordpts, purgepts)
+            logo.count("points removed by simplifyShapeZV",
+                       len(purgepts) - nbrpurge)
+            nbrpurge = len(purgepts)
             coordpts, purgepts = fixSelfIntersect(coordpts, purgepts)
+            logo.count("points removed by fixSelfIntersect",
+                       len(purgepts) - nbrpurge)
 
             # Now the *not so* fun part, we change and delete some segments.
             # The ids will change so we work with point coordinates and we
@@ -522,6 +624,37 @@ class ShapeUtil:
         return True
 
 
+    def isLineCrossing(self, points1, points2):
+        """
+        Check if 2 lines (ordered list of points) are crossing each other.
+        Only segments in the common bounding box of both lines are tested.
+        """
+
+        xmin = max(min([ x for x, y in points1 ]), min([ x for x, y in points2 ]))
+        xmax = min(max([ x for x, y in points1 ]), max([ x for x, y in points2 ]))
+        ymin = max(min([ y for x, y in points1 ]), min([ y for x, y in points2 ]))
+        ymax = min(max([ y for x, y in points1 ]), max([ y for x, y in points2 ]))
+        if xmin > xmax or ymin > ymax:
+            return False
+
+        segments = []
+        for points in (points1, points2):
+            seglist = []
+            for i in xrange(1, len(points)):
+                a, b = points[i-1], points[i]
+                if ((a[0] < xmin and b[0] < xmin) or (a[0] > xmax and b[0] > xmax)
+                  or (a[1] < ymin and b[1] < ymin) or (a[1] > ymax and b[1] > ymax)):
+                    continue
+                seglist.append( (a, b) )
+            segments.append(seglist)
+
+        for a, b in segments[0]:
+            for c, d in segments[1]:
+                if intersect(a, b, c, d):
+                    return True
+        return False
+
+
 def simplifyPoints(points):
     """
     Simplify a line (ordered list of points).
@@ -619,12 +752,9 @@ def simplifyShapeZV(points, ptsdeleted):
             # Keep closest point to line
             if d2 < d1:
                 # Remove point 1
-                logo.DEBUG("Discard %s from Z shape %s %s %s %s" % (
-                             points[i+1],
-                             points[i],
-                             points[i+1],
-                             points[i+2],
-                             points[i+3]))
+                logo.DEBUG("Discard %s from Z shape %s %s %s %s",
+                           points[i+1], points[i], points[i+1],
+                           points[i+2], points[i+3])
                 angledist[i:i+2] = [ (angle_B, dist_B) ]
                 ptsdiscard.append(points[i+1])
                 points = points[:i+1] + points[i+2:]
@@ -632,12 +762,9 @@ def simplifyShapeZV(points, ptsdeleted):
                     i -= 1   # recheck with previous point
             else:
                 # Remove point 2
-                logo.DEBUG("Discard %s from Z shape %s %s %s %s" % (
-                             points[i+2],
-                             points[i],
-                             points[i+1],
-                             points[i+2],
-                             points[i+3]))
+                logo.DEBUG("Discard %s from Z shape %s %s %s %s",
+                           points[i+2], points[i], points[i+1],
+                           points[i+2], points[i+3])
                 angledist[i+1:i+3] = [ (angle_A, dist_A) ]
                 ptsdiscard.append(points[i+2])
                 points = points[:i+2] + points[i+3:]
@@ -694,11 +821,8 @@ def simplifyShapeZV(points, ptsdeleted):
 
         if min(d1, d2) < distmax:
             # Remove point 1
-            logo.DEBUG("Discard %s from V shape %s %s %s" % (
-                         points[i+1],
-                         points[i],
-                         points[i+1],
-                         points[i+2]))
+            logo.DEBUG("Discard %s from V shape %s %s %s",
+                       points[i+1], points[i], points[i+1], points[i+2])
             angledist[i:i+2] = [ (angle_0, dist_0) ]
             ptsdiscard.append(points[i+1])
             points = points[:i+1] + points[i+2:]
@@ -786,23 +910,25 @@ def fixSelfIntersect(points, ptsdeleted):
             if abs(seg1-seg2) == 1:
                 # Delete common vertex from points[1:-1]
                 pt = max(seg1, seg2)
-                logo.WARN("Fix self-intersect removing %s from line %s and %s"
-                          % (points[pt],
-                             tuple(points[pt-1:pt+1]),
-                             tuple(points[pt:pt+2])))
+                logo.WARN("Fix self-intersect removing %s from line %s and %s",
+                          points[pt],
+                          tuple(points[pt-1:pt+1]),
+                          tuple(points[pt:pt+2]))
                 ptsdeleted = ptsdeleted + points[pt:pt+1]
                 points = points[:pt] + points[pt+1:]
                 crossing = findLineIntersection(points)   # recheck
+                logo.count("self-intersections fixed")
             elif (points[0] == points[-1] and (len(points)-2) in (seg1, seg2)
                   and 0 in (seg1, seg2)):
                 # Closed ring and common vertex is the first/last point
-                logo.WARN("Fix self-intersect removing %s from line %s and %s"
-                          % (points[0],
-                             tuple(points[-2:]),
-                             tuple(points[0:2])))
+                logo.WARN("Fix self-intersect removing %s from line %s and %s",
+                          points[0],
+                          tuple(points[-2:]),
+                          tuple(points[0:2]))
                 ptsdeleted = ptsdeleted + points[-1:]
                 points = points[1:-1] + points[1:2]
                 crossing = findLineIntersection(points)   # recheck
+                logo.count("self-intersections fixed")
     elif len(crossing) == 1:
         # Segment N-1 and N+1 can cross when segment N is going backwards
         for segintersect in crossing:
@@ -821,34 +947,37 @@ def fixSelfIntersect(points, ptsdeleted):
                                              points[pt][1])
                 if dist_0 > dist_1:
                     pt = pt-1
-                logo.WARN("Fix self-intersect for line %s and %s removing %s"
-                          % (tuple(points[seg1:seg1+2]),
-                             tuple(points[seg2:seg2+2]),
-                             points[pt]))
+                logo.WARN("Fix self-intersect for line %s and %s removing %s",
+                          tuple(points[seg1:seg1+2]),
+                          tuple(points[seg2:seg2+2]),
+                          points[pt])
                 ptsdeleted = ptsdeleted + points[pt:pt+1]
                 points = points[:pt] + points[pt+1:]
                 crossing = findLineIntersection(points)   # recheck
+                logo.count("self-intersections fixed")
             elif (points[0] == points[-1] and (
                   ((len(points)-2) in (seg1, seg2) and 1 in (seg1, seg2)) or
                   ((len(points)-3) in (seg1, seg2) and 0 in (seg1, seg2)))
                  ):
                 # Closed ring, don't bother to check first/last segment
                 # for simplicity point 0 will be simplified
-                logo.WARN("Fix self-intersect for line %s and %s removing %s"
-                          % (tuple(points[seg1:seg1+2]),
-                             tuple(points[seg2:seg2+2]),
-                             points[0]))
+                logo.WARN("Fix self-intersect for line %s and %s removing %s",
+                          tuple(points[seg1:seg1+2]),
+                          tuple(points[seg2:seg2+2]),
+                          points[0])
                 ptsdeleted = ptsdeleted + points[-1:]
                 points = points[1:-1] + points[1:2]
                 crossing = findLineIntersection(points)   # recheck
+                logo.count("self-intersections fixed")
 
     # Cannot deal with complexe case
     for segintersect in crossing:
         seg1, seg2 = segintersect
-        logo.ERROR("Self-intersect from line %s and %s at %s"
-                   % (tuple(points[seg1:seg1+2]),
-                      tuple(points[seg2:seg2+2]),
-                      crossing[segintersect]))
+        logo.count("self-intersections unfixed")
+        logo.ERROR("Self-intersect from line %s and %s at %s",
+                   tuple(points[seg1:seg1+2]),
+                   tuple(points[seg2:seg2+2]),
+                   crossing[segintersect])
     return (points, ptsdeleted)
 
 
@@ -994,6 +1123,42 @@ def findLineIntersection(points):
     return crossings
 
 
+def hilbertindex(x, y, order=16):
+    """
+    Return distance of cell (x, y) along a Hilbert curve.
+    Cell coordinates are integers in range [0, 2**order[.
+    """
+
+    side = 1 << order
+    dist = 0
+    s = side >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        dist += s * s * ((3 * rx) ^ ry)
+        if not ry:
+            # Rotate quadrant
+            if rx:
+                x = side-1 - x
+                y = side-1 - y
+            x, y = y, x
+        s >>= 1
+    return dist
+
+
+def zorderindex(x, y, order=16):
+    """
+    Return distance of cell (x, y) along a Z-order (Morton) curve.
+    Cell coordinates are integers in range [0, 2**order[.
+    """
+
+    dist = 0
+    for bit in xrange(order):
+        dist |= ((x >> bit) & 1) << (2*bit)
+        dist |= ((y >> bit) & 1) << (2*bit + 1)
+    return dist
+
+
 def cmpcoordxy(a,b):
     """
     Compare coord by X.
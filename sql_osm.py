@@ -1,6 +1,21 @@
-import psycopg2
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None   # only the helpers are used (see sqlite_osm)
 import sys
+import os
 import datetime
+import itertools
+import operator
+import struct
+import shutil
+import tempfile
+import optparse
+import multiprocessing
+import uganda_config
+
+itersize = 50000   # rows fetched at once by the server side cursors
+copybuffer = 1<<24 # COPY data kept in memory before using a temp file
 
 def check_db_uganda(db):
     """ Check for special uganda table."""
@@ -22,60 +37,470 @@ def check_db_uganda(db):
     return True
 
 
-def osm_file(db, filename):
-    reltype = { 'N' : "node", 'W' : "way",  'R' : "relation" }
-    out = open(filename, 'w')
+# Uganda tables: name, columns, keys and indexes created after the load
+uganda_tables = (
+    ("uganda_nodes",
+     """uganda_id bigint NOT NULL,
+        geom geometry(Point, 4326) NOT NULL""",
+     """ALTER TABLE uganda_nodes ADD PRIMARY KEY (uganda_id);
+        CREATE INDEX uganda_nodes_geom ON uganda_nodes USING gist (geom);
+     """),
+    ("uganda_ways",
+     """uganda_id bigint NOT NULL""",
+     """ALTER TABLE uganda_ways ADD PRIMARY KEY (uganda_id);"""),
+    ("uganda_way_nodes",
+     """uganda_id bigint NOT NULL,
+        node_id bigint NOT NULL,
+        sequence_id integer NOT NULL""",
+     """ALTER TABLE uganda_way_nodes
+            ADD PRIMARY KEY (uganda_id, sequence_id);
+        CREATE INDEX uganda_way_nodes_node ON uganda_way_nodes (node_id);
+     """),
+    ("uganda_way_tags",
+     """uganda_id bigint NOT NULL,
+        k text NOT NULL,
+        v text NOT NULL""",
+     """CREATE INDEX uganda_way_tags_id ON uganda_way_tags (uganda_id);"""),
+    ("uganda_relations",
+     """uganda_id bigint NOT NULL""",
+     """ALTER TABLE uganda_relations ADD PRIMARY KEY (uganda_id);"""),
+    ("uganda_relation_tags",
+     """uganda_id bigint NOT NULL,
+        k text NOT NULL,
+        v text NOT NULL""",
+     """CREATE INDEX uganda_relation_tags_id
+            ON uganda_relation_tags (uganda_id);
+     """),
+    ("uganda_relation_members",
+     """uganda_id bigint NOT NULL,
+        member_id bigint NOT NULL,
+        member_type character(1) NOT NULL,
+        member_role text NOT NULL,
+        sequence_id integer NOT NULL""",
+     """ALTER TABLE uganda_relation_members
+            ADD PRIMARY KEY (uganda_id, sequence_id);
+        CREATE INDEX uganda_relation_members_member
+            ON uganda_relation_members (member_id, member_type);
+     """),
+    )
+
+
+def create_db_uganda(db, recreate=False):
+    """
+    Create the missing uganda tables, without index (see index_db_uganda),
+    and the id sequence. Existing tables are kept, unless 'recreate'
+    where all of them are dropped first.
+
+    Return the names of the tables created.
+    """
+
+    names = [ name for name, columns, indexes in uganda_tables ]
     cursor = db.cursor()
-    cursorchild = db.cursor()
-    tmstamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    out.write('<osm version="0.6" generator="test">\n')
-    cursor.execute("""SELECT uganda_id, ST_X(geom), ST_Y(geom)
-                      FROM uganda_nodes
+    if recreate:
+        cursor.execute("""DROP TABLE IF EXISTS %s;
+                          DROP SEQUENCE IF EXISTS seq_uganda_id;
+                       """ % ", ".join(names))
+    created = []
+    for name, columns, indexes in uganda_tables:
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is None:
+            cursor.execute("CREATE TABLE %s (%s)" % (name, columns))
+            created.append(name)
+    cursor.execute("""CREATE SEQUENCE IF NOT EXISTS seq_uganda_id
+                          INCREMENT BY -1 MAXVALUE -1 START WITH -1
                    """)
+    db.commit()
+    return created
+
+
+def index_db_uganda(db, tables):
+    """
+    Create the keys and indexes of the uganda 'tables' once loaded (the
+    ones created by create_db_uganda), and move the id sequence after
+    the ids used.
+    """
+
+    cursor = db.cursor()
+    for name, columns, indexes in uganda_tables:
+        if name in tables:
+            cursor.execute(indexes)
+    cursor.execute("""SELECT setval('seq_uganda_id',
+                                    least(-1,
+                                          (SELECT min(uganda_id)
+                                           FROM uganda_nodes),
+                                          (SELECT min(uganda_id)
+                                           FROM uganda_ways),
+                                          (SELECT min(uganda_id)
+                                           FROM uganda_relations)));
+                      ANALYZE %s;
+                   """ % ", ".join([ name
+                                     for name, columns, indexes
+                                     in uganda_tables ]))
+    db.commit()
+
+
+def copy_text(value):
+    """ Escape a value for the text format of COPY."""
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class CopyBuffer:
+    """
+    Rows of a table in the text format of COPY, in memory or in a
+    temporary file when too large.
+    """
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.data = tempfile.SpooledTemporaryFile(copybuffer)
+        self.rows = 0
+
+
+    def add(self, lines):
+        """ Add rows given as COPY text lines."""
+        self.data.writelines(lines)
+        self.rows += len(lines)
+
+
+    def copy(self, cursor):
+        """ Send the rows to the table (COPY FROM STDIN)."""
+        self.data.seek(0)
+        cursor.copy_from(self.data, self.table, columns=self.columns)
+        self.data.close()
+
+
+def copy_db_uganda(db, nodes, ways, relations, chunksize=4096,
+                   recreate=False):
+    """
+    Load the uganda tables using COPY, from the iterators:
+      nodes     (uganda_id, lon, lat)
+      ways      (uganda_id, [node_id, ...], [(k, v), ...])
+      relations (uganda_id, [(member_id, 'N'|'W'|'R', role), ...],
+                 [(k, v), ...])
+
+    Existing tables are emptied (TRUNCATE) and keep their indexes, the
+    missing ones are created and indexed after the load. With 'recreate'
+    all the tables are dropped and created again.
+    Return the number of rows loaded by table.
+    """
+
+    if recreate or not check_db_uganda(db):
+        created = create_db_uganda(db, recreate)
+    else:
+        created = []
+    cursor = db.cursor()
+    cursor.execute("TRUNCATE %s" % ", ".join([ name
+                                               for name, columns, indexes
+                                               in uganda_tables ]))
+    copied = {}
+
+    # Points as hexadecimal EWKB, little endian, SRID 4326
+    ewkb = struct.pack("<BII", 1, 0x20000001, 4326).encode("hex")
+    buf = CopyBuffer("uganda_nodes", ("uganda_id", "geom"))
+    nodes = iter(nodes)
+    while True:
+        chunk = [ "%d\t%s%s\n" % (nodeid, ewkb,
+                                  struct.pack("<dd", lon, lat).encode("hex"))
+                  for nodeid, lon, lat in itertools.islice(nodes, chunksize) ]
+        if not chunk:
+            break
+        buf.add(chunk)
+    buf.copy(cursor)
+    copied[buf.table] = buf.rows
+
+    for elements, table, refs, refcolumns, tagtable in (
+            (ways, "uganda_ways", "uganda_way_nodes",
+             ("uganda_id", "node_id", "sequence_id"), "uganda_way_tags"),
+            (relations, "uganda_relations", "uganda_relation_members",
+             ("uganda_id", "member_id", "member_type", "member_role",
+              "sequence_id"), "uganda_relation_tags")):
+        bufs = [ CopyBuffer(table, ("uganda_id",)),
+                 CopyBuffer(refs, refcolumns),
+                 CopyBuffer(tagtable, ("uganda_id", "k", "v")) ]
+        chunks = [ [], [], [] ]
+        for elemid, members, tags in elements:
+            chunks[0].append("%d\n" % elemid)
+            for seq, member in enumerate(members):
+                if table == "uganda_ways":
+                    chunks[1].append("%d\t%d\t%d\n" % (elemid, member, seq))
+                else:
+                    ref, typ, role = member
+                    chunks[1].append("%d\t%d\t%s\t%s\t%d\n"
+                                     % (elemid, ref, typ, copy_text(role), seq))
+            for key, value in tags:
+                chunks[2].append("%d\t%s\t%s\n"
+                                 % (elemid, copy_text(key), copy_text(value)))
+            if len(chunks[1]) >= chunksize:
+                for buf, chunk in zip(bufs, chunks):
+                    buf.add(chunk)
+                chunks = [ [], [], [] ]
+        for buf, chunk in zip(bufs, chunks):
+            buf.add(chunk)
+            buf.copy(cursor)
+            copied[buf.table] = buf.rows
+    db.commit()
+
+    index_db_uganda(db, created)
+    return copied
+
+
+def bulk_cursor(db, name, query, args=None):
+    """
+    Execute a query on a named (server side) cursor, rows are fetched by
+    blocks of 'itersize' when iterating.
+    """
+
+    cursor = db.cursor(name)
+    cursor.itersize = itersize
+    cursor.execute(query, args)
+    return cursor
+
+
+def group_rows(rows):
+    """
+    Group rows ordered by their first column (uganda_id).
+
+    Yield (uganda_id, [other columns of each row]).
+    """
+
+    for key, group in itertools.groupby(rows, operator.itemgetter(0)):
+        yield key, [ row[1:] for row in group ]
+
+
+def merge_rows(parents, children):
+    """
+    Merge two streams of grouped rows (see group_rows), both ordered by
+    uganda_id.
+
+    Yield (uganda_id, parent rows, child rows) for each parent, child rows
+    being empty when there is none for this uganda_id.
+    """
+
+    children = iter(children)
+    childid, childrows = next(children, (None, None))
+    for parentid, parentrows in parents:
+        while childid is not None and childid < parentid:
+            childid, childrows = next(children, (None, None))
+        if childid == parentid:
+            yield parentid, parentrows, childrows
+            childid, childrows = next(children, (None, None))
+        else:
+            yield parentid, parentrows, []
+
+
+def range_clause(idrange):
+    """
+    Return the WHERE clause and its arguments selecting the uganda_id in
+    'idrange' (low, high), or all of them if None.
+    """
+
+    if idrange is None:
+        return "", ()
+    return "WHERE uganda_id >= %s AND uganda_id < %s", idrange
+
+
+def id_ranges(db, table, parts):
+    """
+    Split the uganda_id of 'table' in 'parts' ranges (low, high) of about
+    the same number of rows.
+    """
+
+    cursor = db.cursor()
+    cursor.execute("""SELECT percentile_disc(%%s::float8[])
+                                 WITHIN GROUP (ORDER BY uganda_id),
+                             max(uganda_id)
+                      FROM %s
+                   """ % table, ([ float(num) / parts
+                                   for num in xrange(parts) ],))
+    bounds, maxid = cursor.fetchone()
+    db.commit()
+    if maxid is None:
+        return []
+    bounds = sorted(set(bounds)) + [ maxid + 1 ]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def write_nodes(db, out, tmstamp, idrange=None):
+    """ Write the nodes with an uganda_id in 'idrange'."""
+    where, args = range_clause(idrange)
+    cursor = bulk_cursor(db, "uganda_nodes",
+                         """SELECT uganda_id, ST_X(geom), ST_Y(geom)
+                            FROM uganda_nodes %s
+                            ORDER BY uganda_id
+                         """ % where, args)
     for nodeid, lon, lat in cursor:
         out.write('  <node id="%d" lat="%.7f" lon="%.7f" version="0" timestamp="%s"/>\n' % (nodeid, lat, lon, tmstamp))
-    cursor.execute("""SELECT uganda_id FROM uganda_ways""")
-    for (wayid,) in cursor:
-        cursorchild.execute("""SELECT node_id FROM uganda_way_nodes
-                               WHERE uganda_id = %s
-                               ORDER BY sequence_id
-                            """, (wayid,) )
+    cursor.close()
+    db.commit()
+
+
+def write_ways(db, out, tmstamp, idrange=None):
+    """ Write the ways with an uganda_id in 'idrange'."""
+    where, args = range_clause(idrange)
+    cursor = bulk_cursor(db, "uganda_ways",
+                         """SELECT uganda_id, node_id
+                            FROM uganda_ways
+                            LEFT JOIN uganda_way_nodes USING (uganda_id)
+                            %s
+                            ORDER BY uganda_id, sequence_id
+                         """ % where, args)
+    cursortags = bulk_cursor(db, "uganda_way_tags",
+                             """SELECT uganda_id, k, v
+                                FROM uganda_way_tags %s
+                                ORDER BY uganda_id
+                             """ % where, args)
+    for wayid, nodes, tags in merge_rows(group_rows(cursor),
+                                         group_rows(cursortags)):
         out.write('  <way id="%d" version="0" timestamp="%s">\n' % (wayid, tmstamp))
-        for nodeid in cursorchild:
-            out.write('    <nd ref="%d"/>\n' % nodeid)
-        cursorchild.execute("""SELECT k, v FROM uganda_way_tags
-                               WHERE uganda_id = %s
-                            """, (wayid,) )
-        for key, value in cursorchild:
+        for (nodeid,) in nodes:
+            if nodeid is not None:
+                out.write('    <nd ref="%d"/>\n' % nodeid)
+        for key, value in tags:
             out.write('    <tag k="%s" v="%s"/>\n' % (key, value))
         out.write('  </way>\n')
-    cursor.execute("""SELECT uganda_id FROM uganda_relations""")
-    for (relid,) in cursor:
+    cursor.close()
+    cursortags.close()
+    db.commit()
+
+
+def write_relations(db, out, tmstamp, idrange=None):
+    """ Write the relations with an uganda_id in 'idrange'."""
+    reltype = { 'N' : "node", 'W' : "way",  'R' : "relation" }
+    where, args = range_clause(idrange)
+    cursor = bulk_cursor(db, "uganda_relations",
+                         """SELECT uganda_id, member_id, member_type,
+                                   member_role
+                            FROM uganda_relations
+                            LEFT JOIN uganda_relation_members
+                                 USING (uganda_id)
+                            %s
+                            ORDER BY uganda_id, sequence_id
+                         """ % where, args)
+    cursortags = bulk_cursor(db, "uganda_relation_tags",
+                             """SELECT uganda_id, k, v
+                                FROM uganda_relation_tags %s
+                                ORDER BY uganda_id
+                             """ % where, args)
+    for relid, members, tags in merge_rows(group_rows(cursor),
+                                           group_rows(cursortags)):
         out.write('  <relation id="%d" version="0" timestamp="%s">\n' % (relid, tmstamp))
-        cursorchild.execute("""SELECT k, v FROM uganda_relation_tags
-                               WHERE uganda_id = %s
-                            """, (relid,) )
-        for key, value in cursorchild:
+        for key, value in tags:
             out.write('    <tag k="%s" v="%s"/>\n' % (key, value))
-        cursorchild.execute("""SELECT member_id, member_type, member_role
-                               FROM uganda_relation_members
-                               WHERE uganda_id = %s
-                               ORDER BY sequence_id
-                            """, (relid,) )
-        for ref, typ, role in cursorchild:
-            out.write('    <member type="%s" ref="%d" role="%s"/>\n' % (reltype[typ], ref, role))
+        for ref, typ, role in members:
+            if ref is not None:
+                out.write('    <member type="%s" ref="%d" role="%s"/>\n' % (reltype[typ], ref, role))
         out.write('  </relation>\n')
-    out.write('  </osm>\n')
+    cursor.close()
+    cursortags.close()
+    db.commit()
+
+
+element_writers = ( ("uganda_nodes", write_nodes),
+                    ("uganda_ways", write_ways),
+                    ("uganda_relations", write_relations) )
+
+
+def export_init(dsn):
+    """ Open the database connection of an export worker."""
+    global export_db
+    export_db = psycopg2.connect(dsn)
+
+
+def export_segment(task):
+    """
+    Write the elements of one table in an uganda_id range to a segment
+    file (worker side).
+
+    Return the segment file name.
+    """
+
+    segment, table, idrange, tmstamp = task
+    out = open(segment, "w")
+    dict(element_writers)[table](export_db, out, tmstamp, idrange)
+    out.close()
+    return segment
+
+
+def export_segments(db, out, tmstamp, dsn, workers):
+    """
+    Write the tables split in uganda_id ranges by 'workers' processes
+    to segments in a temporary directory next to 'out', the segments
+    are concatenated to 'out' in node/way/relation order.
+    """
+
+    tmpdir = tempfile.mkdtemp(".tmp", os.path.basename(out.name) + ".",
+                              os.path.dirname(os.path.abspath(out.name)))
+    try:
+        tasks = []
+        for table, writer in element_writers:
+            for idrange in id_ranges(db, table, workers):
+                segment = os.path.join(tmpdir, "%d.osm" % len(tasks))
+                tasks.append( (segment, table, idrange, tmstamp) )
+        pool = multiprocessing.Pool(workers, export_init, (dsn,))
+        try:
+            for segment in pool.imap(export_segment, tasks):
+                data = open(segment)
+                shutil.copyfileobj(data, out, 1<<20)
+                data.close()
+                os.remove(segment)
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(tmpdir, True)
+
+
+def osm_file(db, filename, dsn=None, workers=1):
+    """
+    Write the uganda_* tables in an OSM file.
+
+    Each element type is read by two queries ordered by uganda_id (the
+    elements joined with their nodes or members, and their tags) merged
+    in a single pass.
+
+    With several 'workers', each table is split in uganda_id ranges
+    written to temporary segments by processes having their own
+    connection to 'dsn' (see export_segments).
+    The file is removed if the export fails.
+    """
+
+    out = open(filename, 'w')
+    try:
+        tmstamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<osm version="0.6" generator="test">\n')
+        if workers > 1 and dsn:
+            export_segments(db, out, tmstamp, dsn, workers)
+        else:
+            for table, writer in element_writers:
+                writer(db, out, tmstamp)
+        out.write('  </osm>\n')
+    except:
+        out.close()
+        os.remove(filename)
+        raise
+    out.close()
 
 
 if __name__ == "__main__":
-    db = psycopg2.connect("dbname=osmosis")
+    parser = optparse.OptionParser(usage="%prog [options] file.osm")
+    parser.add_option("-d", "--dsn", default="dbname=osmosis",
+                      help="database connection [%default]")
+    parser.add_option("-j", "--workers", type="int",
+                      default=uganda_config.workers,
+                      help="processes (and connections) used for the"
+                           " export, 0 = number of CPU [%default]")
+    (options, args) = parser.parse_args()
+    db = psycopg2.connect(options.dsn)
     if not check_db_uganda(db):
         print "Error UGANDA database"
         sys.exit(1)
-    if len(sys.argv) != 2:
+    if len(args) != 1:
         print "Error Syntax"
         sys.exit(1)
-    osm_file(db, sys.argv[1])
-
+    osm_file(db, args[0], options.dsn,
+             options.workers or multiprocessing.cpu_count())
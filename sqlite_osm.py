@@ -0,0 +1,641 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+SQLite store of a run, without server:
+- the ShapeUtil topology (points, segment links, lines) and the admin
+  areas (shape_* tables), read back by load_topology() to write the
+  outputs of a run without reading and simplifying the input again
+- the nodes, ways and relations, same tables as the PostgreSQL ones of
+  sql_osm (uganda_*), exported by osm_file() from the tables
+- the digests of the objects with stable ids (uganda_index), used as
+  the previous run by 'uganda_build.py --diff'
+
+Lines, admin areas, nodes, ways and relations are indexed by bounding
+box in R*Tree virtual tables (<table>_rtree).
+"""
+
+import sys
+import datetime
+import itertools
+import optparse
+import sqlite3
+import shapeu as shapeutil
+import writeosm
+from sql_osm import group_rows, merge_rows
+from geolookup import wkb_polygons
+
+
+def connect(filename):
+    """
+    Open (or create) the SQLite database 'filename'.
+    """
+
+    db = sqlite3.connect(filename)
+    db.text_factory = str   # tags are UTF8 strings
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    return db
+
+
+def isstore(filename):
+    """ Check if 'filename' is a SQLite database."""
+    try:
+        header = open(filename, "rb").read(16)
+    except IOError:
+        return False
+    return header == "SQLite format 3\0"
+
+
+def create_topology(db):
+    """
+    (Re)create the tables of the ShapeUtil topology and admin areas.
+    """
+
+    db.executescript("""
+        DROP TABLE IF EXISTS shape_info;
+        DROP TABLE IF EXISTS shape_points;
+        DROP TABLE IF EXISTS shape_segments;
+        DROP TABLE IF EXISTS shape_lines;
+        DROP TABLE IF EXISTS shape_lines_rtree;
+        DROP TABLE IF EXISTS shape_admins;
+        DROP TABLE IF EXISTS shape_admins_rtree;
+        DROP TABLE IF EXISTS shape_admin_lines;
+        DROP TABLE IF EXISTS shape_admin_rings;
+        CREATE TABLE shape_info (
+            name TEXT PRIMARY KEY,
+            value);
+        CREATE TABLE shape_points (
+            pointid INTEGER PRIMARY KEY,
+            lon REAL NOT NULL,
+            lat REAL NOT NULL);
+        CREATE TABLE shape_segments (
+            segmentdir INTEGER PRIMARY KEY,
+            next INTEGER NOT NULL,
+            lon REAL,
+            lat REAL,
+            lineid INTEGER NOT NULL);
+        CREATE TABLE shape_lines (
+            lineid INTEGER PRIMARY KEY,
+            first INTEGER NOT NULL,
+            last INTEGER NOT NULL);
+        CREATE VIRTUAL TABLE shape_lines_rtree
+            USING rtree(lineid, minlon, maxlon, minlat, maxlat);
+        CREATE TABLE shape_admins (
+            num INTEGER PRIMARY KEY,
+            adm UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            level INTEGER NOT NULL,
+            parent,
+            old_name TEXT,
+            area REAL,
+            minlon REAL,
+            maxlon REAL,
+            minlat REAL,
+            maxlat REAL,
+            geom BLOB);
+        CREATE VIRTUAL TABLE shape_admins_rtree
+            USING rtree(num, minlon, maxlon, minlat, maxlat);
+        CREATE TABLE shape_admin_lines (
+            num INTEGER NOT NULL,
+            lineid INTEGER NOT NULL,
+            role TEXT NOT NULL);
+        CREATE TABLE shape_admin_rings (
+            num INTEGER NOT NULL,
+            polygon INTEGER NOT NULL,
+            ring INTEGER NOT NULL,
+            sequence_id INTEGER NOT NULL,
+            lineid INTEGER NOT NULL);
+        """)
+    db.commit()
+
+
+def save_topology(db, shapeu, admins, chunksize=4096):
+    """
+    Store the ShapeUtil topology and the admin areas (see load_topology),
+    rows are inserted by batches of 'chunksize' in one transaction.
+
+    ShapeUtil arrays are stored as they are: point ids and segment links
+    are the ones of 'shapeu', rings of the areas (outer line ring then
+    its inner line rings, see verify_admin) are kept.
+    """
+
+    create_topology(db)
+    db.executemany("INSERT INTO shape_info VALUES (?,?)",
+                   [ ("segment_count", shapeu.segment_count),
+                     ("line_count", shapeu.line_count),
+                     ("cachemem", shapeu.cachemem),
+                     ("precision", shapeutil.precision) ])
+
+    points = shapeu.iterPoints()
+    while True:
+        chunk = [ (pointid, coord[0], coord[1])
+                  for pointid, coord in itertools.islice(points, chunksize) ]
+        if not chunk:
+            break
+        db.executemany("INSERT INTO shape_points VALUES (?,?,?)", chunk)
+
+    for start in xrange(0, shapeu.segment_count, chunksize):
+        chunk = []
+        for segmentdir in xrange(start, min(start + chunksize,
+                                            shapeu.segment_count)):
+            coord = shapeu.coord_pnt[segmentdir] or (None, None)
+            chunk.append( (segmentdir, shapeu.segment_connect[segmentdir],
+                           coord[0], coord[1],
+                           shapeu.line_seg[segmentdir/2]) )
+        db.executemany("INSERT INTO shape_segments VALUES (?,?,?,?,?)",
+                       chunk)
+
+    lines = []
+    bboxes = []
+    for lineid in xrange(1, shapeu.line_count+1):
+        lines.append( (lineid, shapeu.line_ends[(lineid-1)*2],
+                       shapeu.line_ends[(lineid-1)*2+1]) )
+        coords = shapeu.getLineCoords(lineid)
+        bboxes.append( (lineid, min([ coord[0] for coord in coords ]),
+                        max([ coord[0] for coord in coords ]),
+                        min([ coord[1] for coord in coords ]),
+                        max([ coord[1] for coord in coords ])) )
+        if len(lines) >= chunksize:
+            db.executemany("INSERT INTO shape_lines VALUES (?,?,?)", lines)
+            db.executemany("INSERT INTO shape_lines_rtree VALUES (?,?,?,?,?)",
+                           bboxes)
+            lines = []
+            bboxes = []
+    db.executemany("INSERT INTO shape_lines VALUES (?,?,?)", lines)
+    db.executemany("INSERT INTO shape_lines_rtree VALUES (?,?,?,?,?)", bboxes)
+
+    for num, adm in enumerate(sorted(admins)):
+        admin = admins[adm]
+        geom = None
+        if "polygons" in admin:
+            geom = sqlite3.Binary(writeosm.wkb_multipolygon(admin["polygons"]))
+        bbox = admin.get("bbox") or (None, None, None, None)
+        db.execute("""INSERT INTO shape_admins
+                      VALUES (?,?,?,?,?,?,?,?,?,?,?,?)""",
+                   (num, adm, admin["name"], admin["level"],
+                    admin.get("parent"), admin.get("old_name"),
+                    admin.get("area")) + tuple(bbox) + (geom,))
+        # R*Tree coordinates are 32 bits floats, exact bbox in shape_admins
+        if admin.get("bbox"):
+            db.execute("INSERT INTO shape_admins_rtree VALUES (?,?,?,?,?)",
+                       (num,) + tuple(admin["bbox"]))
+        db.executemany("INSERT INTO shape_admin_lines VALUES (?,?,?)",
+                       [ (num, lineid, role) for role in ("outer", "inner")
+                         for lineid in admin[role] ])
+        db.executemany("INSERT INTO shape_admin_rings VALUES (?,?,?,?,?)",
+                       [ (num, polynum, ringnum, seq, lineid)
+                         for polynum, (outer, inners)
+                             in enumerate(admin.get("rings", ()))
+                         for ringnum, ring in enumerate([ outer ] + inners)
+                         for seq, lineid in enumerate(ring) ])
+    db.commit()
+
+    db.executescript("""
+        CREATE INDEX shape_admin_lines_num ON shape_admin_lines (num);
+        CREATE INDEX shape_admin_lines_line ON shape_admin_lines (lineid);
+        CREATE INDEX shape_admin_rings_num
+            ON shape_admin_rings (num, polygon, ring, sequence_id);
+        """)
+    db.commit()
+
+
+def load_topology(db, mem=0):
+    """
+    Read back the ShapeUtil topology and the admin areas stored by
+    save_topology(), 'mem' is the minimum size of the ShapeUtil arrays.
+
+    Return (shapeu, admins).
+    """
+
+    info = dict(db.execute("SELECT name, value FROM shape_info"))
+    shapeutil.precision = info["precision"]
+    shapeu = shapeutil.ShapeUtil(max(mem, info["cachemem"]))
+    shapeu.segment_count = info["segment_count"]
+    shapeu.line_count = info["line_count"]
+    for pointid, lon, lat in db.execute("""SELECT pointid, lon, lat
+                                           FROM shape_points"""):
+        shapeu.point_pos[(lon, lat)] = pointid
+    for segmentdir, nextdir, lon, lat, lineid in db.execute(
+                        """SELECT segmentdir, next, lon, lat, lineid
+                           FROM shape_segments"""):
+        shapeu.segment_connect[segmentdir] = nextdir
+        if lon is not None:
+            shapeu.coord_pnt[segmentdir] = (lon, lat)
+        shapeu.line_seg[segmentdir/2] = lineid
+    for first, last in db.execute("""SELECT first, last FROM shape_lines
+                                     ORDER BY lineid"""):
+        shapeu.line_ends.append(first)
+        shapeu.line_ends.append(last)
+
+    admins = {}
+    nums = {}
+    for (num, adm, name, level, parent, old_name, area,
+         minlon, maxlon, minlat, maxlat, geom) in db.execute(
+                        """SELECT num, adm, name, level, parent, old_name,
+                                  area, minlon, maxlon, minlat, maxlat, geom
+                           FROM shape_admins"""):
+        admin = { "name" : name,
+                  "level" : level,
+                  "inner" : set(),
+                  "outer" : set(),
+                  "rings" : [],
+                }
+        if parent is not None:
+            admin["parent"] = parent
+        if old_name is not None:
+            admin["old_name"] = old_name
+        if geom is not None:
+            admin["polygons"] = wkb_polygons(str(geom))[0]
+            admin["area"] = area
+            admin["bbox"] = None
+            if minlon is not None:
+                admin["bbox"] = (minlon, maxlon, minlat, maxlat)
+        admins[adm] = admin
+        nums[num] = adm
+    for num, lineid, role in db.execute("""SELECT num, lineid, role
+                                           FROM shape_admin_lines"""):
+        admins[nums[num]][role].add(lineid)
+    for num, polynum, ringnum, lineid in db.execute(
+                        """SELECT num, polygon, ring, lineid
+                           FROM shape_admin_rings
+                           ORDER BY num, polygon, ring, sequence_id"""):
+        rings = admins[nums[num]]["rings"]
+        if polynum == len(rings):
+            rings.append( ([], []) )
+        outer, inners = rings[polynum]
+        if ringnum == 0:
+            outer.append(lineid)
+        else:
+            if ringnum > len(inners):
+                inners.append([])
+            inners[ringnum-1].append(lineid)
+    return shapeu, admins
+
+
+def lines_in_bbox(db, bbox):
+    """
+    Return the ids of the lines of the topology intersecting 'bbox'
+    (xmin, xmax, ymin, ymax).
+    """
+
+    xmin, xmax, ymin, ymax = bbox
+    return [ lineid for (lineid,) in db.execute(
+                """SELECT lineid FROM shape_lines_rtree
+                   WHERE maxlon >= ? AND minlon <= ?
+                     AND maxlat >= ? AND minlat <= ?
+                """, (xmin, xmax, ymin, ymax)) ]
+
+
+def admins_in_bbox(db, bbox):
+    """
+    Return the keys of the admin areas intersecting 'bbox'
+    (xmin, xmax, ymin, ymax).
+    """
+
+    xmin, xmax, ymin, ymax = bbox
+    return [ adm for (adm,) in db.execute(
+                """SELECT adm FROM shape_admins
+                   JOIN shape_admins_rtree AS rtree USING (num)
+                   WHERE rtree.maxlon >= ? AND rtree.minlon <= ?
+                     AND rtree.maxlat >= ? AND rtree.minlat <= ?
+                """, (xmin, xmax, ymin, ymax)) ]
+
+
+def save_index(db, entries):
+    """
+    Store the index of a run with stable ids, (type, id, digest) of each
+    object (see uganda_build.write_index).
+    """
+
+    db.executescript("""
+        DROP TABLE IF EXISTS uganda_index;
+        CREATE TABLE uganda_index (
+            type TEXT NOT NULL,
+            uganda_id INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (type, uganda_id));
+        """)
+    db.executemany("INSERT INTO uganda_index VALUES (?,?,?)", entries)
+    db.commit()
+
+
+def read_index(db):
+    """
+    Read the index of a run stored by save_index.
+
+    Return a dictionary (type, id) -> digest.
+    """
+
+    return dict([ ((objtype, objid), digest)
+                  for objtype, objid, digest in db.execute(
+                      "SELECT type, uganda_id, digest FROM uganda_index") ])
+
+
+def check_db_uganda(db):
+    """ Check for special uganda table."""
+    try:
+        db.execute("""SELECT max(uganda_id) FROM uganda_nodes
+                      UNION
+                      SELECT max(uganda_id) FROM uganda_ways
+                      UNION
+                      SELECT max(uganda_id) FROM uganda_relations
+                   """).fetchall()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+uganda_tables = ("uganda_nodes", "uganda_ways", "uganda_way_nodes",
+                 "uganda_way_tags", "uganda_relations",
+                 "uganda_relation_tags", "uganda_relation_members",
+                 "uganda_nodes_rtree", "uganda_ways_rtree",
+                 "uganda_relations_rtree")
+
+
+def create_db_uganda(db, recreate=False):
+    """
+    Create the missing uganda tables, without index (see index_db_uganda).
+    Existing tables are kept, unless 'recreate' where all of them are
+    dropped first.
+    """
+
+    if recreate:
+        db.executescript("".join([ "DROP TABLE IF EXISTS %s;\n" % name
+                                   for name in uganda_tables ]))
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS uganda_nodes (
+            uganda_id INTEGER PRIMARY KEY,
+            lon REAL NOT NULL,
+            lat REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS uganda_ways (
+            uganda_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS uganda_way_nodes (
+            uganda_id INTEGER NOT NULL,
+            node_id INTEGER NOT NULL,
+            sequence_id INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS uganda_way_tags (
+            uganda_id INTEGER NOT NULL,
+            k TEXT NOT NULL,
+            v TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS uganda_relations (
+            uganda_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS uganda_relation_tags (
+            uganda_id INTEGER NOT NULL,
+            k TEXT NOT NULL,
+            v TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS uganda_relation_members (
+            uganda_id INTEGER NOT NULL,
+            member_id INTEGER NOT NULL,
+            member_type TEXT NOT NULL,
+            member_role TEXT NOT NULL,
+            sequence_id INTEGER NOT NULL);
+        CREATE VIRTUAL TABLE IF NOT EXISTS uganda_nodes_rtree
+            USING rtree(uganda_id, minlon, maxlon, minlat, maxlat);
+        CREATE VIRTUAL TABLE IF NOT EXISTS uganda_ways_rtree
+            USING rtree(uganda_id, minlon, maxlon, minlat, maxlat);
+        CREATE VIRTUAL TABLE IF NOT EXISTS uganda_relations_rtree
+            USING rtree(uganda_id, minlon, maxlon, minlat, maxlat);
+        """)
+    db.commit()
+
+
+def index_db_uganda(db):
+    """
+    Create the indexes of the uganda tables once loaded and fill the
+    R*Tree of the ways and relations from their nodes.
+    """
+
+    db.executescript("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uganda_way_nodes_id
+            ON uganda_way_nodes (uganda_id, sequence_id);
+        CREATE INDEX IF NOT EXISTS uganda_way_nodes_node
+            ON uganda_way_nodes (node_id);
+        CREATE INDEX IF NOT EXISTS uganda_way_tags_id
+            ON uganda_way_tags (uganda_id);
+        CREATE INDEX IF NOT EXISTS uganda_relation_tags_id
+            ON uganda_relation_tags (uganda_id);
+        CREATE UNIQUE INDEX IF NOT EXISTS uganda_relation_members_id
+            ON uganda_relation_members (uganda_id, sequence_id);
+        CREATE INDEX IF NOT EXISTS uganda_relation_members_member
+            ON uganda_relation_members (member_id, member_type);
+        INSERT INTO uganda_ways_rtree
+            SELECT uganda_way_nodes.uganda_id, min(lon), max(lon),
+                   min(lat), max(lat)
+            FROM uganda_way_nodes
+            JOIN uganda_nodes ON uganda_nodes.uganda_id = node_id
+            GROUP BY uganda_way_nodes.uganda_id;
+        INSERT INTO uganda_relations_rtree
+            SELECT uganda_relation_members.uganda_id, min(minlon),
+                   max(maxlon), min(minlat), max(maxlat)
+            FROM uganda_relation_members
+            JOIN uganda_ways_rtree ON uganda_ways_rtree.uganda_id = member_id
+            WHERE member_type = 'W'
+            GROUP BY uganda_relation_members.uganda_id;
+        ANALYZE;
+        """)
+    db.commit()
+
+
+def copy_db_uganda(db, nodes, ways, relations, chunksize=4096,
+                   recreate=False):
+    """
+    Load the uganda tables from iterators (see sql_osm.copy_db_uganda),
+    rows are inserted by batches of 'chunksize' in one transaction.
+
+    Existing tables are emptied, the missing ones are created, and they
+    are indexed after the load. With 'recreate' all the tables are
+    dropped and created again.
+    Return the number of rows loaded by table.
+    """
+
+    create_db_uganda(db, recreate)
+    for name in uganda_tables:
+        db.execute("DELETE FROM %s" % name)
+    copied = dict.fromkeys([ "uganda_nodes", "uganda_ways",
+                             "uganda_way_nodes", "uganda_way_tags",
+                             "uganda_relations", "uganda_relation_tags",
+                             "uganda_relation_members" ], 0)
+
+    def insert(table, rows):
+        if rows:
+            db.executemany("INSERT INTO %s VALUES (%s)"
+                           % (table, ",".join("?" * len(rows[0]))), rows)
+            copied[table] += len(rows)
+
+    nodes = iter(nodes)
+    while True:
+        chunk = list(itertools.islice(nodes, chunksize))
+        if not chunk:
+            break
+        insert("uganda_nodes", chunk)
+        db.executemany("INSERT INTO uganda_nodes_rtree VALUES (?,?,?,?,?)",
+                       [ (nodeid, lon, lon, lat, lat)
+                         for nodeid, lon, lat in chunk ])
+
+    chunks = ([], [], [])
+    for wayid, nodeids, tags in ways:
+        chunks[0].append( (wayid,) )
+        chunks[1].extend([ (wayid, nodeid, seq)
+                           for seq, nodeid in enumerate(nodeids) ])
+        chunks[2].extend([ (wayid, key, value) for key, value in tags ])
+        if len(chunks[1]) >= chunksize:
+            for table, chunk in zip(("uganda_ways", "uganda_way_nodes",
+                                     "uganda_way_tags"), chunks):
+                insert(table, chunk)
+            chunks = ([], [], [])
+    for table, chunk in zip(("uganda_ways", "uganda_way_nodes",
+                             "uganda_way_tags"), chunks):
+        insert(table, chunk)
+
+    chunks = ([], [], [])
+    for relid, members, tags in relations:
+        chunks[0].append( (relid,) )
+        chunks[1].extend([ (relid, ref, typ, role, seq)
+                           for seq, (ref, typ, role) in enumerate(members) ])
+        chunks[2].extend([ (relid, key, value) for key, value in tags ])
+        if len(chunks[1]) >= chunksize:
+            for table, chunk in zip(("uganda_relations",
+                                     "uganda_relation_members",
+                                     "uganda_relation_tags"), chunks):
+                insert(table, chunk)
+            chunks = ([], [], [])
+    for table, chunk in zip(("uganda_relations", "uganda_relation_members",
+                             "uganda_relation_tags"), chunks):
+        insert(table, chunk)
+    db.commit()
+
+    index_db_uganda(db)
+    return copied
+
+
+def bbox_filter(bbox):
+    """
+    Return the WHERE clauses (nodes, ways, relations) and their arguments
+    selecting the relations intersecting 'bbox' (xmin, xmax, ymin, ymax)
+    with their ways and nodes, or all of them if None.
+    """
+
+    if bbox is None:
+        return ("", "", ""), ((), (), ())
+    xmin, xmax, ymin, ymax = bbox
+    relations = """uganda_id IN (SELECT uganda_id
+                                 FROM uganda_relations_rtree
+                                 WHERE maxlon >= ? AND minlon <= ?
+                                   AND maxlat >= ? AND minlat <= ?)"""
+    ways = """uganda_id IN (SELECT member_id
+                            FROM uganda_relation_members
+                            WHERE member_type = 'W' AND %s)""" % relations
+    nodes = """uganda_id IN (SELECT node_id
+                             FROM uganda_way_nodes
+                             WHERE %s)""" % ways
+    args = (xmin, xmax, ymin, ymax)
+    return ("WHERE " + nodes, "WHERE " + ways, "WHERE " + relations), \
+           (args, args, args)
+
+
+def osm_file(db, filename, bbox=None):
+    """
+    Write the uganda tables in an OSM file, only the relations
+    intersecting 'bbox' (xmin, xmax, ymin, ymax) and their ways and nodes
+    if given.
+
+    Same queries as sql_osm.osm_file, rows are read while writing.
+    """
+
+    reltype = { 'N' : "node", 'W' : "way",  'R' : "relation" }
+    (wherenodes, whereways, whererels), (argsnodes, argsways, argsrels) = \
+        bbox_filter(bbox)
+    out = open(filename, 'w')
+    tmstamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osm version="0.6" generator="test">\n')
+    for nodeid, lon, lat in db.execute("""SELECT uganda_id, lon, lat
+                                          FROM uganda_nodes %s
+                                          ORDER BY uganda_id
+                                       """ % wherenodes, argsnodes):
+        out.write('  <node id="%d" lat="%.7f" lon="%.7f" version="0" timestamp="%s"/>\n' % (nodeid, lat, lon, tmstamp))
+
+    ways = db.execute("""SELECT uganda_id, node_id
+                         FROM uganda_ways
+                         LEFT JOIN uganda_way_nodes USING (uganda_id)
+                         %s
+                         ORDER BY uganda_id, sequence_id
+                      """ % whereways, argsways)
+    tags = db.execute("""SELECT uganda_id, k, v
+                          FROM uganda_way_tags %s
+                          ORDER BY uganda_id
+                       """ % whereways, argsways)
+    for wayid, nodes, waytags in merge_rows(group_rows(ways),
+                                            group_rows(tags)):
+        out.write('  <way id="%d" version="0" timestamp="%s">\n' % (wayid, tmstamp))
+        for (nodeid,) in nodes:
+            if nodeid is not None:
+                out.write('    <nd ref="%d"/>\n' % nodeid)
+        for key, value in waytags:
+            out.write('    <tag k="%s" v="%s"/>\n' % (key, value))
+        out.write('  </way>\n')
+
+    relations = db.execute("""SELECT uganda_id, member_id, member_type,
+                                     member_role
+                              FROM uganda_relations
+                              LEFT JOIN uganda_relation_members
+                                   USING (uganda_id)
+                              %s
+                              ORDER BY uganda_id, sequence_id
+                           """ % whererels, argsrels)
+    tags = db.execute("""SELECT uganda_id, k, v
+                          FROM uganda_relation_tags %s
+                          ORDER BY uganda_id
+                       """ % whererels, argsrels)
+    for relid, members, reltags in merge_rows(group_rows(relations),
+                                              group_rows(tags)):
+        out.write('  <relation id="%d" version="0" timestamp="%s">\n' % (relid, tmstamp))
+        for key, value in reltags:
+            out.write('    <tag k="%s" v="%s"/>\n' % (key, value))
+        for ref, typ, role in members:
+            if ref is not None:
+                out.write('    <member type="%s" ref="%d" role="%s"/>\n' % (reltype[typ], ref, role))
+        out.write('  </relation>\n')
+    out.write('  </osm>\n')
+    out.close()
+
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(
+                usage="%prog [options] file.sqlite file.osm")
+    parser.add_option("--bbox", metavar="XMIN,YMIN,XMAX,YMAX",
+                      help="only export the relations intersecting the"
+                           " bounding box, with their ways and nodes")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.error("Error Syntax")
+    bbox = None
+    if options.bbox:
+        try:
+            xmin, ymin, xmax, ymax = map(float, options.bbox.split(","))
+        except ValueError:
+            parser.error("--bbox needs 4 numbers")
+        bbox = (xmin, xmax, ymin, ymax)
+    db = connect(args[0])
+    if not check_db_uganda(db):
+        print "Error UGANDA database"
+        sys.exit(1)
+    osm_file(db, args[1], bbox)
@@ -25,12 +25,27 @@ import sys
 import re
 import os
 import datetime
+import itertools
+import collections
+import array
+import struct
+import optparse
+import hashlib
+import json
+import multiprocessing
 from osgeo import gdal, ogr, osr
+try:
+    import psycopg2
+    import sql_osm
+except ImportError:
+    psycopg2 = None
+import sqlite_osm
 import shapeu as shapeutil
-from ringue import FindClosedRings
+from ringue import FindClosedRings, RingCache, ringcontains, ringarea
 import logo
 import uganda_config
 import parseosm
+import writeosm
 
 # GDAL 1.9.0 can do the ISO8859-1 to UTF-8 recoding for us
 # but will do it ourself to be backward compatible
@@ -87,12 +102,46 @@ def convertname(name):
     return name.encode("UTF8")
 
 
-def read_UGANDA(filename, shapeu):
+def ringcoords(polygon):
     """
-    Read the shapefile and build the geometry.
+    Return the outer ring of a polygon as a flat array (lon, lat, ...).
+
+    Coordinates are decoded in one pass from the WKB export of the polygon
+    instead of calling GetPoint_2D() for each vertex.
+    """
+
+    # Little-endian WKB : byte order, type, nbr rings, nbr points, points
+    wkb = polygon.ExportToWkb(ogr.wkbNDR)
+    geomtype, nbrings, nbpoints = struct.unpack_from('<III', wkb, 1)
+    if geomtype & 0x80000000:
+        dim = 3                             # 2.5D (old style Z flag)
+    elif geomtype >= 1000:
+        dim = (2, 3, 3, 4)[geomtype / 1000] # ISO Z, M, ZM
+    else:
+        dim = 2
+    coords = array.array('d')
+    coords.fromstring(str(wkb[13:13 + nbpoints*dim*8]))
+    if sys.byteorder != 'little':
+        coords.byteswap()
+
+    if dim != 2:
+        # Drop extra dimensions
+        coords2d = array.array('d', coords[0:nbpoints*2])
+        coords2d[0::2] = coords[0::dim]
+        coords2d[1::2] = coords[1::dim]
+        coords = coords2d
+    return coords
+
+
+def load_UGANDA(filename):
+    """
+    Read the shapefile, reproject and extract each polygon.
 
     We expect only 1 layer of type polygon, coordinates are reprojected
     to WGS84.
+    Return the list of features (subregion, district, ring) where ring is
+    a string of packed doubles (lon, lat, lon, lat, ...) and the list of
+    debug messages (text, args) (this can run in a worker process).
     """
 
     shapefile = ogr.Open(filename)
@@ -111,14 +160,24 @@ def read_UGANDA(filename, shapeu):
     if layerDef.GetGeomType() != ogr.wkbPolygon:
         raise logo.ERROR("Not a POLYGON file")
 
+    # Extract attributes from district or merged file
+    if layerDef.GetFieldIndex("SUBREGION") == -1:
+        fieldregion = "region"
+        fielddistrict = "place"
+    else:
+        fieldregion = "SUBREGION"
+        fielddistrict = "DNAME_2010"
+
     # Reproject on the fly
     srcSpatialRef = layer.GetSpatialRef()
     dstSpatialRef = osr.SpatialReference()
     dstSpatialRef.SetWellKnownGeogCS('WGS84')
     transform = osr.CoordinateTransformation(srcSpatialRef, dstSpatialRef)
 
-    # Read each polygon and build the connection arrays (point, segment, line)
-    logo.starting("Geometry read", layer.GetFeatureCount())
+    # Read each polygon
+    features = []
+    messages = []
+    logo.starting("Geometry load", layer.GetFeatureCount())
     for featnum in xrange(layer.GetFeatureCount()):
         logo.progress(featnum)
         feature = layer.GetFeature(featnum)
@@ -131,62 +190,62 @@ def read_UGANDA(filename, shapeu):
         # we create all segments for outer ring only, drop
         # inner rings (very exotic ...)
         if newgeometry.GetGeometryType() == ogr.wkbMultiPolygon:
-            logo.DEBUG("Feature %d with %d polygons" % (featnum,
-                       newgeometry.GetGeometryCount()))
-            ring = newgeometry.GetGeometryRef(0).GetGeometryRef(0)
+            messages.append( ("Feature %d with %d polygons",
+                              (featnum, newgeometry.GetGeometryCount())) )
+            ring = ringcoords(newgeometry.GetGeometryRef(0))
         else:
-            logo.DEBUG("Feature %d with %d rings" % (featnum,
-                       newgeometry.GetGeometryCount()))
-            ring = newgeometry.GetGeometryRef(0)
-        lon1, lat1 = ring.GetPoint_2D(0)
-        for pnt in xrange(1, ring.GetPointCount()):
-            lon2, lat2 = ring.GetPoint_2D(pnt)
-            shapeu.makeSegment(lon1, lat1, lon2, lat2)
-            lon1, lat1 = lon2, lat2
+            messages.append( ("Feature %d with %d rings",
+                              (featnum, newgeometry.GetGeometryCount())) )
+            ring = ringcoords(newgeometry)
+
+        features.append( (feature.GetField(fieldregion),
+                          feature.GetField(fielddistrict),
+                          ring.tostring()) )
     logo.ending()
+    return (features, messages)
 
 
-def admin_UGANDA(filename, shapeu, admins):
+def read_UGANDA(features, shapeu):
     """
-    Reread the shapefile and build each administrative entity.
+    Build the geometry from the features of a shapefile (see load_UGANDA).
 
-    Geometry described by a set of lines, attributes converted to UTF8.
+    Return the list of features (subregion, district, ring) where ring is
+    a flat array of rounded coordinates (lon, lat, lon, lat, ...).
     """
 
-    shapefile = ogr.Open(filename)
-    layer = shapefile.GetLayer(0)
-    layerDef = layer.GetLayerDefn()
+    # Read each polygon and build the connection arrays (point, segment, line)
+    rounded = []
+    logo.starting("Geometry read", len(features))
+    for featnum, (subregion, district, ringdata) in enumerate(features):
+        logo.progress(featnum)
+        ring = array.array('d')
+        ring.fromstring(ringdata)
 
-    # Reproject on the fly
-    srcSpatialRef = layer.GetSpatialRef()
-    dstSpatialRef = osr.SpatialReference()
-    dstSpatialRef.SetWellKnownGeogCS('WGS84')
-    transform = osr.CoordinateTransformation(srcSpatialRef, dstSpatialRef)
+        # Keep rounded coordinates, the admin area will be built from them
+        coords = shapeu.addRing(itertools.izip(ring[0::2], ring[1::2]))
+        rounded.append( (subregion, district, coords) )
+    shapeu.flushCounts()
+    logo.ending()
+    return rounded
 
-    # Extract attributes from district or merged file
-    if layerDef.GetFieldIndex("SUBREGION") == -1:
-        fieldregion = "region"
-        fielddistrict = "place"
-    else:
-        fieldregion = "SUBREGION"
-        fielddistrict = "DNAME_2010"
+
+def admin_UGANDA(features, shapeu, admins):
+    """
+    Build each administrative entity from the features read.
+
+    Geometry described by a set of lines, attributes converted to UTF8.
+    """
 
     # Change here the admin area level !!!
     LevelSubRegion = 6
     LevelDistrict = 7
 
-    # Reread each polygon and create the right administrative area
-    logo.starting("Attributes read", layer.GetFeatureCount())
-    for featnum in xrange(layer.GetFeatureCount()):
+    # Use each polygon and create the right administrative area
+    logo.starting("Attributes read", len(features))
+    for featnum, (subregion, district, coords) in enumerate(features):
         logo.progress(featnum)
-        feature = layer.GetFeature(featnum)
-        geometry  = feature.GetGeometryRef()
-        newgeometry = geometry.Clone()
-        newgeometry.Transform(transform)
-        subregion = feature.GetField(fieldregion)
-        district  = feature.GetField(fielddistrict)
-        logo.DEBUG("Feature %d SUBREGION='%s' DISTRICT='%s'" % (
-                   featnum, subregion, district))
+        logo.DEBUG("Feature %d SUBREGION='%s' DISTRICT='%s'",
+                   featnum, subregion, district)
 
         # Subregion / District
         if district is None:
@@ -222,6 +281,7 @@ def admin_UGANDA(filename, shapeu, admins):
             if key_admin2 not in admins:
                 admins[key_admin2] = { "name" : convertname(district),
                                        "level" : LevelDistrict,
+                                       "parent" : key_admin1,
                                        "inner" : set(),
                                        "outer" : set(),
                                      }
@@ -229,14 +289,9 @@ def admin_UGANDA(filename, shapeu, admins):
         # Build sets of lineid, deal only outer, inner rings
         # are useless and wrong
         lineset = set()
-        if newgeometry.GetGeometryType() == ogr.wkbMultiPolygon:
-            ring = newgeometry.GetGeometryRef(0).GetGeometryRef(0)
-        else:
-            ring = newgeometry.GetGeometryRef(0)
         pntinring = []
-        for pnt in xrange(ring.GetPointCount()):
-            lon, lat = ring.GetPoint_2D(pnt)
-            pointid = shapeu.getPoint(lon, lat)
+        for pnt in xrange(0, len(coords), 2):
+            pointid = shapeu.getPointRounded( (coords[pnt], coords[pnt+1]) )
             if pointid is not None:
                 pntinring.append(pointid)
 
@@ -260,144 +315,1104 @@ def admin_UGANDA(filename, shapeu, admins):
     logo.ending()
 
 
-def verify_admin(shapeu, admins):
+def verify_area(task):
+    """
+    Build the rings of one administrative area (worker side).
+
+    Return (area key, discarded lines, polygons, valid rings, stats,
+    shape), lines discarded are given as (lineid, number of points, first,
+    last point), polygons as (outer ring, list of inner rings) with the
+    lines of each ring in order, stats are the FindClosedRings counters
+    and the 'pid' of the process.
+    The shape is None unless asked by verify_admin, else (polygons, bbox,
+    area) with the polygons given by coordinates, outer rings counter
+    clockwise and inner rings clockwise.
+    """
+
+    adm, lines = task
+
+    # Administrative areas read from the shapefile are also checked
+    # and dispatched into outer/inner ring, even if technically only
+    # the upper and reconstructed admin level need it (the shapefile
+    # already knows what's outer and inner, but we avoid a special
+    # case and it cannot fail unless something was really wrong).
+    closedrings = FindClosedRings(verify_shapeu, lines, verify_cache,
+                                  *verify_budget)
+    discarded = []
+    for line in closedrings.getLineDiscarded():
+        coords = verify_cache.getLineCoords(line)
+        discarded.append( (line, len(coords), coords[0], coords[-1]) )
+
+    polygons = []
+    for outer, inner in sorted(closedrings.iterPolygons()):
+        polygons.append( (closedrings.getLineRing(outer),
+                          [ closedrings.getLineRing(ring) for ring in inner ]) )
+    rings = [ closedrings.getLineRing(ring)
+              for ring in xrange(closedrings.nbrRing()) ]
+    stats = closedrings.getStats()
+    stats["pid"] = os.getpid()
+
+    shape = None
+    if verify_shapes:
+        coordpolygons = []
+        bbox = None
+        area = 0.0
+        for outer, inner in sorted(closedrings.iterPolygons()):
+            coords = closedrings.getCoordRing(outer)
+            ringsurf = ringarea(coords)
+            if ringsurf < 0:
+                coords = coords[::-1]
+            area += abs(ringsurf)
+            innercoords = []
+            for ring in inner:
+                coords2 = closedrings.getCoordRing(ring)
+                ringsurf = ringarea(coords2)
+                if ringsurf > 0:
+                    coords2 = coords2[::-1]
+                area -= abs(ringsurf)
+                innercoords.append(coords2)
+            coordpolygons.append( (coords, innercoords) )
+
+            xmin, xmax, ymin, ymax = closedrings.getExtentRing(outer)
+            if bbox is not None:
+                xmin = min(xmin, bbox[0])
+                xmax = max(xmax, bbox[1])
+                ymin = min(ymin, bbox[2])
+                ymax = max(ymax, bbox[3])
+            bbox = (xmin, xmax, ymin, ymax)
+        shape = (coordpolygons, bbox, area)
+    return (adm, discarded, polygons, rings, stats, shape)
+
+
+def verify_admin(shapeu, admins, workers=1, maxattempts=0, maxtime=0,
+                 shapes=False):
     """
     Check that all administrative area are closed.
 
-    Also search for inner ring and update 'admins'.
+    Also search for inner ring and update 'admins', the polygons found
+    are kept in the 'rings' key of each area (see verify_area).
+    Lowest levels are verified first, upper levels reuse the rings already
+    validated for their children and only check the new junctions.
+    Areas of the same level are dispatched to 'workers' processes, they
+    share the geometry with the main process (fork) and only send back
+    the lines to move into inner rings.
+    The search for rings in one area is bounded by 'maxattempts' and
+    'maxtime' (see FindClosedRings).
+    With 'shapes', the coordinates of the polygons are also kept in the
+    'polygons' key, their bounding box (xmin, xmax, ymin, ymax) in 'bbox'
+    and their area (square meters) in 'area'.
     """
 
+    global verify_shapeu, verify_cache, verify_budget, verify_shapes
+
+    verify_shapeu = shapeu
+    verify_cache = RingCache(shapeu)
+    verify_budget = (maxattempts, maxtime)
+    verify_shapes = shapes
     logo.starting("Verify admin area", len(admins))
+    levels = sorted(set([ admins[adm]["level"] for adm in admins ]),
+                    reverse=True)
+    for level in levels:
+        tasks = [ (adm, admins[adm]["outer"]) for adm in sorted(admins)
+                  if admins[adm]["level"] == level ]
+        if workers > 1 and len(tasks) > 1:
+            # Pool created after the cache update, forked processes
+            # inherit the rings validated in the previous levels
+            logo.flush()
+            pool = multiprocessing.Pool(workers, logo.detach)
+            results = pool.imap(verify_area, tasks,
+                                max(1, len(tasks) / (workers*4)))
+        else:
+            pool = None
+            results = itertools.imap(verify_area, tasks)
+
+        for adm, discarded, polygons, rings, stats, shape in results:
+            logo.progress()
+            logo.DEBUG("Area level=%(level)d '%(name)s'", admins[adm])
+            logo.DEBUG("Rings search %(attempts)d attempts, %(backtracks)d"
+                       " backtracks, %(checks)d checks in %(elapsed).3fs",
+                       stats)
+            logo.addSpan("FindClosedRings", stats["start"],
+                         stats["start"] + stats["elapsed"], stats["pid"],
+                         area=admins[adm]["name"], level=admins[adm]["level"],
+                         backtracks=stats["backtracks"])
+            logo.count("ring attempts", stats["attempts"])
+            logo.count("ring backtracks", stats["backtracks"])
+            logo.count("ring checks", stats["checks"])
+            logo.observe("ring_search_seconds", stats["elapsed"],
+                         "Time to find the closed rings of an area",
+                         level=admins[adm]["level"])
+            if stats["exhausted"]:
+                logo.count("ring search exhausted")
+                logo.WARN("Area '%s' search budget exceeded, lines discarded",
+                          admins[adm]["name"])
+            if discarded:
+                logo.count("rings not closed")
+                logo.ERROR("Area '%s' ring not closed\n",
+                           admins[adm]["name"])
+                for line, nbr, first, last in discarded:
+                    logo.DEBUG("Line in ring with %d points still open %s -> %s",
+                               nbr, first, last)
+
+            # Moving lineids from outer to inner, rings kept for the
+            # order of relation members
+            admins[adm]["rings"] = polygons
+            if shape is not None:
+                (admins[adm]["polygons"], admins[adm]["bbox"],
+                 admins[adm]["area"]) = shape
+            for outer, inners in polygons:
+                for lineids in inners:
+                    admins[adm]["outer"].difference_update(lineids)
+                    admins[adm]["inner"].update(lineids)
+            for lineids in rings:
+                verify_cache.addValidRing(lineids)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logo.ending()
+
+
+class OsmIds:
+    """
+    Give OSM ids to points, lines and admin areas and order the output.
+
+    Default numbering: negative ShapeUtil ids in ShapeUtil order.
+    """
+
+    def __init__(self, shapeu):
+        self.shapeu = shapeu
+
+
+    def iterNodes(self):
+        """
+        Generator function on node id and coordinates (output order).
+        """
+
+        for pointid, coord in self.shapeu.iterPoints():
+            yield -(pointid+1), coord
+
+
+    def iterWays(self):
+        """
+        Generator function on lineid, way id and list of node id
+        (output order).
+        """
+
+        for lineid, pntids in self.shapeu.iterLines():
+            yield lineid, -lineid, [ -(pointid+1) for pointid in pntids ]
+
+
+    def nodeId(self, pointid):
+        """ Return node id of a point. """
+        return -(pointid+1)
+
+
+    def wayId(self, lineid):
+        """ Return way id of a line. """
+        return -lineid
+
+
+    def wayNodes(self, lineid):
+        """ Return list of node id of a line (output direction). """
+        return [ self.nodeId(pointid)
+                 for pointid in self.shapeu.getLinePoints(lineid) ]
+
+
+    def relationId(self, num, adm):
+        """ Return relation id of the 'num'th admin area 'adm'. """
+        return -(num+1)
+
+
+    def nbrObjects(self, admins):
+        """ Return number of nodes, ways, relations written. """
+        return self.shapeu.nbrPoints() + self.shapeu.nbrLines() + len(admins)
+
+
+class SpatialOsmIds(OsmIds):
+    """
+    Renumber nodes along a space filling curve ('hilbert' or 'zorder'),
+    ways are renumbered in the order of their first node.
+
+    Neighbour objects get close ids and are written together, ids only
+    depend on the geometry (ties are sorted by coordinates).
+    """
+
+    def __init__(self, shapeu, curve="hilbert", order=16):
+        self.shapeu = shapeu
+        if curve == "zorder":
+            curveindex = shapeutil.zorderindex
+        else:
+            curveindex = shapeutil.hilbertindex
+
+        # Scale bounding box to the curve grid
+        points = list(shapeu.iterPoints())
+        if points:
+            xmin = min([ coord[0] for pointid, coord in points ])
+            xmax = max([ coord[0] for pointid, coord in points ])
+            ymin = min([ coord[1] for pointid, coord in points ])
+            ymax = max([ coord[1] for pointid, coord in points ])
+        else:
+            xmin = xmax = ymin = ymax = 0.0
+        scale = ((1 << order) - 1) / max(xmax - xmin, ymax - ymin, 1e-9)
+
+        points.sort(key=lambda p: (curveindex(int((p[1][0] - xmin) * scale),
+                                              int((p[1][1] - ymin) * scale),
+                                              order), p[1]))
+        self.points = [ coord for pointid, coord in points ]
+        self.nodeids = {}
+        for num, (pointid, coord) in enumerate(points):
+            self.nodeids[pointid] = -(num+1)
+
+        lines = [ (-self.nodeids[pntids[0]], -self.nodeids[pntids[-1]],
+                   lineid) for lineid, pntids in shapeu.iterLines() ]
+        lines.sort()
+        self.lines = [ lineid for first, last, lineid in lines ]
+        self.wayids = {}
+        for num, lineid in enumerate(self.lines):
+            self.wayids[lineid] = -(num+1)
+
+
+    def iterNodes(self):
+        for num, coord in enumerate(self.points):
+            yield -(num+1), coord
+
+
+    def iterWays(self):
+        nodeids = self.nodeids
+        for num, lineid in enumerate(self.lines):
+            pntids = self.shapeu.getLinePoints(lineid)
+            yield lineid, -(num+1), [ nodeids[pointid] for pointid in pntids ]
+
+
+    def nodeId(self, pointid):
+        return self.nodeids[pointid]
+
+
+    def wayId(self, lineid):
+        return self.wayids[lineid]
+
+
+class StableOsmIds(OsmIds):
+    """
+    Ids derived from the content, identical between two runs for the same
+    object (see write_uganda_diff).
+
+    - node: fixed point coordinates (1e-7) packed in 63 bits
+    - way: hash of its end nodes (and rank of the lines sharing both ends)
+    - relation: hash of the admin area key
+    Nodes and ways are written in id order, ways start from the end with
+    the lowest node id.
+    """
+
+    def __init__(self, shapeu):
+        self.shapeu = shapeu
+
+        # Exact coordinates for OSM precision, a collision (only possible
+        # with a precision finer than 7 digits) takes the next free id
+        points = sorted(shapeu.iterPoints(), key=lambda p: p[1])
+        self.nodeids = {}
+        used = set()
+        for pointid, coord in points:
+            nodeid = -((int(round((coord[0]+180.0) * 10000000)) << 31)
+                       | int(round((coord[1]+90.0) * 10000000)))
+            while nodeid in used:
+                nodeid -= 1
+            used.add(nodeid)
+            self.nodeids[pointid] = nodeid
+        self.points = sorted([ (self.nodeids[pointid], coord)
+                               for pointid, coord in points ], reverse=True)
+
+        # Lines with the same ends are ranked by their middle point
+        lines = []
+        for lineid, pntids in shapeu.iterLines():
+            nodeids = self.lineNodes(pntids)
+            lines.append( (nodeids[0], nodeids[-1], nodeids[len(nodeids)/2],
+                           lineid) )
+        lines.sort()
+        self.wayids = {}
+        used = set()
+        rank = 0
+        for i, (first, last, middle, lineid) in enumerate(lines):
+            if i and lines[i-1][0:2] == (first, last):
+                rank += 1
+            else:
+                rank = 0
+            wayid = stablehash("%d %d %d" % (first, last, rank))
+            while wayid in used:
+                wayid -= 1
+            used.add(wayid)
+            self.wayids[lineid] = wayid
+        self.lines = sorted(self.wayids, key=self.wayids.get, reverse=True)
+
+
+    def lineNodes(self, pntids):
+        """
+        Return the node ids of a line, in the direction starting with the
+        lowest node id (lines can be built in both directions).
+        """
+
+        nodeids = [ self.nodeids[pointid] for pointid in pntids ]
+        reverse = nodeids[::-1]
+        if reverse < nodeids:
+            return reverse
+        return nodeids
+
+
+    def iterNodes(self):
+        return iter(self.points)
+
+
+    def iterWays(self):
+        for lineid in self.lines:
+            yield lineid, self.wayids[lineid], self.wayNodes(lineid)
+
+
+    def nodeId(self, pointid):
+        return self.nodeids[pointid]
+
+
+    def wayId(self, lineid):
+        return self.wayids[lineid]
+
+
+    def wayNodes(self, lineid):
+        return self.lineNodes(self.shapeu.getLinePoints(lineid))
+
+
+    def relationId(self, num, adm):
+        return stablehash(str(adm))
+
+
+class ShardOsmIds(OsmIds):
+    """
+    Restrict the objects given by 'ids' to the lines 'lines' and their
+    nodes. Relations keep the id they have in the whole file, 'adminnums'
+    gives the position of each area in the whole admins.
+
+    Only the lines of the shard are read, nodes and ways are written in
+    decreasing id order (the order of 'ids' when not given by ShapeUtil).
+    """
+
+    def __init__(self, ids, lines, adminnums):
+        self.ids = ids
+        self.shapeu = ids.shapeu
+        self.adminnums = adminnums
+        self.ways = sorted([ (ids.wayId(lineid), lineid) for lineid in lines ],
+                           reverse=True)
+        coords = {}
+        for lineid in lines:
+            for pointid, coord in itertools.izip(
+                                    self.shapeu.getLinePoints(lineid),
+                                    self.shapeu.getLineCoords(lineid)):
+                coords[ids.nodeId(pointid)] = coord
+        self.nodes = sorted(coords.iteritems(), reverse=True)
+
+
+    def iterNodes(self):
+        return iter(self.nodes)
+
+
+    def iterWays(self):
+        for wayid, lineid in self.ways:
+            yield lineid, wayid, self.ids.wayNodes(lineid)
+
+
+    def nodeId(self, pointid):
+        return self.ids.nodeId(pointid)
+
+
+    def wayNodes(self, lineid):
+        return self.ids.wayNodes(lineid)
+
+
+    def wayId(self, lineid):
+        return self.ids.wayId(lineid)
+
+
+    def relationId(self, num, adm):
+        return self.ids.relationId(self.adminnums[adm], adm)
+
+
+    def nbrObjects(self, admins):
+        return len(self.nodes) + len(self.ways) + len(admins)
+
+
+def stablehash(text):
+    """ Return a negative id (52 bits) derived from 'text'. """
+
+    return -(int(hashlib.md5(text).hexdigest()[:13], 16) + 1)
+
+
+def way_levels(admins):
+    """
+    Return the admin level of each line (lowest level of areas using it).
+    """
+
+    waylevel = {}
     for adm in admins:
-        logo.progress()
-        logo.DEBUG("Area level=%(level)d '%(name)s'" % admins[adm])
-
-        # Administrative areas read from the shapefile are also checked
-        # and dispatched into outer/inner ring, even if technically only
-        # the upper and reconstructed admin level need it (the shapefile
-        # already knows what's outer and inner, but we avoid a special
-        # case and it cannot fail unless something was really wrong).
-        closedrings = FindClosedRings(shapeu, admins[adm]["outer"])
-        if closedrings.getLineDiscarded():
-            logo.ERROR("Area '%s' ring not closed\n"
-                       % (admins[adm]["name"]) )
-            for line in closedrings.getLineDiscarded():
-                coords = shapeu.getLineCoords(line)
-                logo.DEBUG("Line in ring with %d points still open %s -> %s"
-                           % (len(coords), coords[0], coords[-1]) )
-
-        # Moving lineids from outer to inner and compute envelope
-        for outer, inner in closedrings.iterPolygons():
-            for ring in inner:
-                lineids = closedrings.getLineRing(ring)
-                admins[adm]["outer"].difference_update(lineids)
-                admins[adm]["inner"].update(lineids)
+        for lineid in admins[adm]["outer"]:
+            level = min(waylevel.get(lineid, 8), admins[adm]["level"])
+            waylevel[lineid] = level
+    return waylevel
 
-    logo.ending()
 
+def relation_tags(admin):
+    """
+    Return list of tags (key, value) of an admin area.
+    """
+
+    tags = [ ("type", "boundary"),
+             ("boundary", "administrative"),
+             ("admin_level", str(admin["level"])),
+             ("name", admin["name"]) ]
+    if "old_name" in admin:
+        tags.append( ("old_name", admin["old_name"]) )
+    return tags
+
+
+def relation_members(admin):
+    """
+    Generator function on (lineid, role) of an admin area.
+
+    Lines are given ring by ring when the rings are known (see
+    verify_admin), each outer ring followed by its inner rings, then
+    the lines not in any ring.
+    """
 
-def write_uganda(fileout, shapeu, admins):
+    done = set()
+    for outer, inners in admin.get("rings", ()):
+        for lineid in outer:
+            done.add(lineid)
+            yield (lineid, "outer")
+        for inner in inners:
+            for lineid in inner:
+                done.add(lineid)
+                yield (lineid, "inner")
+    for role in ("outer", "inner"):
+        for lineid in admin[role]:
+            if lineid not in done:
+                yield (lineid, role)
+
+
+def write_uganda(filename, shapeu, admins, ids=None, chunksize=4096):
     """
     Import with an unique id all nodes, ways, relations.
+
+    Ids and order are given by 'ids' (OsmIds by default).
+    Objects are formatted by chunk of 'chunksize' and written by a
+    background thread.
     """
 
-    logo.starting("Saving nodes, ways, relations",
-                  shapeu.nbrPoints() + shapeu.nbrLines() + len(admins))
+    if ids is None:
+        ids = OsmIds(shapeu)
+    logo.starting("Saving nodes, ways, relations", ids.nbrObjects(admins))
 
-    out = open(fileout+"_out.osm", "w")
+    out = writeosm.ThreadWriter(filename)
     tmstamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
     out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
     out.write('<osm version="0.6" generator="test">\n')
+    done = 0
 
     # Points -> Nodes
     logo.DEBUG("Write nodes")
-    for pointid, coord in shapeu.iterPoints():
-        logo.progress()
-        out.write('  <node id="-%d" lat="%.7f" lon="%.7f" version="0" timestamp="%s"/>\n'
-                  % (pointid+1, coord[1], coord[0], tmstamp))
+    fmtnode = ('  <node id="%%d" lat="%%.7f" lon="%%.7f" version="0" timestamp="%s"/>\n'
+               % tmstamp)
+    nodes = ids.iterNodes()
+    while True:
+        chunk = [ fmtnode % (nodeid, coord[1], coord[0])
+                  for nodeid, coord in itertools.islice(nodes, chunksize) ]
+        if not chunk:
+            break
+        out.write(''.join(chunk))
+        done += len(chunk)
+        logo.progress(done)
 
     # Lines -> Ways
     logo.DEBUG("Write ways")
-    waylevel = {}
-    for adm in admins:
-        for lineid in admins[adm]["outer"]:
-            level = min(waylevel.get(lineid, 8), admins[adm]["level"])
-            waylevel[lineid] = level
-    for lineid, pntids in shapeu.iterLines():
-        logo.progress()
-        out.write('  <way id="-%d" version="0" timestamp="%s">\n' % (lineid, tmstamp))
-        for pointid in pntids:
-            out.write('    <nd ref="-%d"/>\n' % (pointid+1))
-        out.write('    <tag k="boundary" v="administrative"/>\n')
+    waylevel = way_levels(admins)
+    fmtway = '  <way id="%%d" version="0" timestamp="%s">\n    <nd ref="' % tmstamp
+    chunk = []
+    for lineid, wayid, nodeids in ids.iterWays():
+        chunk.append(fmtway % wayid)
+        chunk.append('"/>\n    <nd ref="'.join(map(str, nodeids)))
+        chunk.append('"/>\n    <tag k="boundary" v="administrative"/>\n')
         try:
-            out.write('    <tag k="admin_level" v="%s"/>\n' % waylevel[lineid])
+            chunk.append('    <tag k="admin_level" v="%s"/>\n' % waylevel[lineid])
         except KeyError:
             pass  # because of inner ring in middle of river and not in any admin area outer
-        out.write('  </way>\n')
+        chunk.append('  </way>\n')
+        done += 1
+        if len(chunk) >= chunksize:
+            out.write(''.join(chunk))
+            chunk = []
+            logo.progress(done)
+    out.write(''.join(chunk))
 
     # Admins -> Relations
     logo.DEBUG("Write relations")
+    chunk = []
     for (num,adm) in enumerate(admins):
+        chunk.append('  <relation id="%d" version="0" timestamp="%s">\n'
+                     % (ids.relationId(num, adm), tmstamp))
+        for lineid, role in relation_members(admins[adm]):
+            chunk.append('    <member type="way" ref="%d" role="%s"/>\n'
+                         % (ids.wayId(lineid), role))
+        for key, value in relation_tags(admins[adm]):
+            chunk.append('    <tag k="%s" v="%s"/>\n' % (key, value))
+        chunk.append('  </relation>\n')
+        done += 1
+        if len(chunk) >= chunksize:
+            out.write(''.join(chunk))
+            chunk = []
+            logo.progress(done)
+    chunk.append('  </osm>\n')
+    out.write(''.join(chunk))
+    out.close()
+    logo.ending()
+
+
+def write_uganda_pbf(filename, shapeu, admins, ids=None):
+    """
+    Same as write_uganda() in the OSM PBF format.
+    """
+
+    if ids is None:
+        ids = OsmIds(shapeu)
+    logo.starting("Saving nodes, ways, relations (pbf)",
+                  ids.nbrObjects(admins))
+    out = writeosm.PbfWriter(filename)
+
+    # Points -> Nodes
+    logo.DEBUG("Write nodes")
+    for nodeid, coord in ids.iterNodes():
         logo.progress()
-        out.write('  <relation id="-%d" version="0" timestamp="%s">\n' % (num+1, tmstamp))
-        for role in ("outer", "inner"):
-            for lineid in admins[adm][role]:
-                out.write('    <member type="way" ref="-%d" role="%s"/>\n' % (lineid, role))
-        out.write('    <tag k="type" v="boundary"/>\n')
-        out.write('    <tag k="boundary" v="administrative"/>\n')
-        out.write('    <tag k="admin_level" v="%d"/>\n' % admins[adm]["level"])
-        out.write('    <tag k="name" v="%s"/>\n' % admins[adm]["name"])
-        if "old_name" in admins[adm]:
-            out.write('    <tag k="old_name" v="%s"/>\n' % admins[adm]["old_name"])
-        out.write('  </relation>\n')
-    out.write('  </osm>\n')
+        out.addNode(nodeid, coord[0], coord[1])
+
+    # Lines -> Ways
+    logo.DEBUG("Write ways")
+    waylevel = way_levels(admins)
+    for lineid, wayid, nodeids in ids.iterWays():
+        logo.progress()
+        tags = [ ("boundary", "administrative") ]
+        if lineid in waylevel:
+            tags.append( ("admin_level", str(waylevel[lineid])) )
+        out.addWay(wayid, nodeids, tags)
+
+    # Admins -> Relations
+    logo.DEBUG("Write relations")
+    for (num,adm) in enumerate(admins):
+        logo.progress()
+        members = [ ("way", ids.wayId(lineid), role)
+                    for lineid, role in relation_members(admins[adm]) ]
+        out.addRelation(ids.relationId(num, adm), members,
+                        relation_tags(admins[adm]))
+    out.close()
+    logo.ending()
+
+
+def write_uganda_db(db, backend, shapeu, admins, ids=None, recreate=False):
+    """
+    Load nodes, ways, relations in the uganda_* tables of the database
+    'db', with the same ids as the output file. Existing tables are
+    emptied, or dropped and created again if 'recreate'.
+
+    'backend' is the module of the database: sql_osm (PostgreSQL) or
+    sqlite_osm.
+    """
+
+    logo.starting("Loading nodes, ways, relations in database",
+                  shapeu.nbrPoints() + shapeu.nbrLines() + len(admins))
+    if ids is None:
+        ids = OsmIds(shapeu)
+
+    def nodes():
+        for nodeid, coord in ids.iterNodes():
+            logo.progress()
+            yield (nodeid, coord[0], coord[1])
+
+    def ways():
+        waylevel = way_levels(admins)
+        for lineid, wayid, nodeids in ids.iterWays():
+            logo.progress()
+            tags = [ ("boundary", "administrative") ]
+            if lineid in waylevel:
+                tags.append( ("admin_level", str(waylevel[lineid])) )
+            yield (wayid, nodeids, tags)
+
+    def relations():
+        for (num,adm) in enumerate(admins):
+            logo.progress()
+            members = [ (ids.wayId(lineid), 'W', role)
+                        for lineid, role in relation_members(admins[adm]) ]
+            yield (ids.relationId(num, adm), members,
+                   relation_tags(admins[adm]))
+
+    copied = backend.copy_db_uganda(db, nodes(), ways(), relations(),
+                                    recreate=recreate)
+    for table in sorted(copied):
+        logo.DEBUG("Table %s %d rows", table, copied[table])
+        logo.count("rows copied", copied[table])
     logo.ending()
 
 
-def read_UGANDA_OSM(filename, shapeu):
+def area_contains(shapeu, admin, lines):
+    """
+    Check if the area made of 'lines' is inside the area 'admin'.
+    """
+
+    boundary = admin["outer"] | admin["inner"]
+    notshared = [ lineid for lineid in lines if lineid not in boundary ]
+    if not notshared:
+        # Same limits, unless it's the hole of an inner ring
+        return not lines <= admin["inner"]
+
+    # Crossing count of a half line starting in the middle of a segment
+    # not on the boundary, each line of the boundary toggles it
+    coords = shapeu.getLineCoords(notshared[0])
+    point = ((coords[0][0] + coords[1][0]) / 2,
+             (coords[0][1] + coords[1][1]) / 2)
+    inside = False
+    for lineid in boundary:
+        if ringcontains(shapeu.getLineCoords(lineid), [ point ]):
+            inside = not inside
+    return inside
+
+
+def admin_shards(shapeu, admins):
+    """
+    Dispatch administrative areas under their top level area, using
+    the 'parent' key of the area or the geometry if not known.
+
+    Return dictionary top level area key -> list of area keys.
+    """
+
+    toplevel = min([ admins[adm]["level"] for adm in admins ])
+    shards = {}
+    for adm in admins:
+        if admins[adm]["level"] == toplevel:
+            shards[adm] = [ adm ]
+    for adm in sorted(admins):
+        if adm in shards:
+            continue
+        top = adm
+        while top not in shards and admins[top].get("parent") in admins:
+            top = admins[top]["parent"]
+        if top not in shards:
+            top = None
+            lines = admins[adm]["outer"] | admins[adm]["inner"]
+            for key in sorted(shards):
+                if (admins[key]["level"] == toplevel
+                    and area_contains(shapeu, admins[key], lines)):
+                    top = key
+                    break
+        if top is None:
+            logo.WARN("Area '%s' not in any top level area, written alone",
+                      admins[adm]["name"])
+            shards[adm] = [ adm ]
+        else:
+            shards[top].append(adm)
+    return shards
+
+
+def write_shard(task):
+    """
+    Write the file of one shard (worker side).
+
+    Return (filename, number of relations, number of ways, file size).
+    """
+
+    filename, adms, lines = task
+    shapeu, admins, ids, adminnums, writer = shard_context
+    shardadmins = dict([ (adm, admins[adm]) for adm in adms ])
+    writer(filename, shapeu, shardadmins, ShardOsmIds(ids, lines, adminnums))
+    return (filename, len(adms), len(lines), os.path.getsize(filename))
+
+
+def shard_suffix(basename):
+    """
+    Split an output file name in name and suffix (.osm or .osm.pbf and
+    the compression .gz or .bz2, last extension otherwise).
+    """
+
+    compress = ""
+    for ext in (".gz", ".bz2"):
+        if basename.endswith(ext):
+            basename, compress = basename[:-len(ext)], ext
+    for ext in (".osm.pbf", ".osm"):
+        if basename.endswith(ext):
+            return basename[:-len(ext)], ext + compress
+    basename, ext = os.path.splitext(basename)
+    return basename, ext + compress
+
+
+def write_shards(filename, writer, shapeu, admins, ids, workers=1):
+    """
+    Write one file per top level administrative area with all its areas
+    and the lines they need, named from 'filename' with the area key.
+
+    Files are written by 'writer' (write_uganda or write_uganda_pbf) in
+    'workers' processes. A manifest (filename + '_shards.json') gives the
+    files and the way ids written in more than one file.
+    """
+
+    global shard_context
+
+    dirname, basename = os.path.split(filename)
+    basename, suffix = shard_suffix(basename)
+    shards = admin_shards(shapeu, admins)
+    adminnums = dict([ (adm, num) for num, adm in enumerate(admins) ])
+    shard_context = (shapeu, admins, ids, adminnums, writer)
+
+    tasks = []
+    manifest = { "files" : {}, "shared_ways" : {} }
+    waysin = {}
+    shardnames = set()
+    for top in sorted(shards):
+        lines = set()
+        for adm in shards[top]:
+            lines.update(admins[adm]["outer"])
+            lines.update(admins[adm]["inner"])
+        for lineid in lines:
+            waysin.setdefault(lineid, []).append(top)
+        shardname = re.sub("[^0-9A-Za-z]+", "_", str(top)).strip("_").lower()
+        if not shardname or shardname in shardnames:
+            # Keys differing only by case or punctuation
+            shardname = ("%s_%d" % (shardname, adminnums[top])).strip("_")
+        if shardname in shardnames:
+            raise logo.ERROR("Shard file name '%s' used twice (area '%s')"
+                             % (shardname, admins[top]["name"]))
+        shardnames.add(shardname)
+        shardfile = os.path.join(dirname,
+                                 basename + "_" + shardname + suffix)
+        manifest["files"][str(top)] = { "name" : admins[top]["name"],
+                                        "file" : os.path.basename(shardfile),
+                                        "areas" : len(shards[top]),
+                                        "ways" : len(lines) }
+        tasks.append( (shardfile, shards[top], lines) )
+    for lineid in waysin:
+        if len(waysin[lineid]) > 1:
+            manifest["shared_ways"][str(ids.wayId(lineid))] = [
+                str(top) for top in waysin[lineid] ]
+
+    if workers > 1 and len(tasks) > 1:
+        # Writers are quiet in the workers, one meter for all shards
+        logo.starting("Saving shards", len(tasks))
+        logo.flush()
+        pool = multiprocessing.Pool(workers, logo.detach)
+        results = pool.imap_unordered(write_shard, tasks)
+    else:
+        pool = None
+        results = itertools.imap(write_shard, tasks)
+    for shardfile, nbradmins, nbrlines, size in results:
+        if pool is not None:
+            # Counters of the workers are lost
+            logo.progress()
+            logo.count("bytes written", size)
+        logo.DEBUG("Shard '%s' %d areas, %d ways",
+                   shardfile, nbradmins, nbrlines)
+    if pool is not None:
+        pool.close()
+        pool.join()
+        logo.ending()
+
+    manifestfile = os.path.join(dirname, basename + "_shards.json")
+    out = open(manifestfile, "w")
+    json.dump(manifest, out, indent=1, sort_keys=True)
+    out.close()
+    logo.INFO("%d shards, %d ways shared, manifest '%s'",
+              len(tasks), len(manifest["shared_ways"]), manifestfile)
+
+
+def osm_elements(shapeu, admins, ids):
+    """
+    Generator function on (type, id, key, XML element) for all nodes,
+    ways, relations. Elements have no timestamp. The key is the element
+    to digest: for relations the members are sorted by way id (ring order
+    depends on the line numbering), so it only changes when the object
+    changes, the element keeps the members in ring order.
+    """
+
+    for nodeid, coord in ids.iterNodes():
+        element = ('  <node id="%d" lat="%.7f" lon="%.7f" version="0"/>\n'
+                   % (nodeid, coord[1], coord[0]))
+        yield ("node", nodeid, element, element)
+
+    waylevel = way_levels(admins)
+    for lineid, wayid, nodeids in ids.iterWays():
+        element = [ '  <way id="%d" version="0">\n' % wayid ]
+        for nodeid in nodeids:
+            element.append('    <nd ref="%d"/>\n' % nodeid)
+        element.append('    <tag k="boundary" v="administrative"/>\n')
+        if lineid in waylevel:
+            element.append('    <tag k="admin_level" v="%s"/>\n'
+                           % waylevel[lineid])
+        element.append('  </way>\n')
+        element = ''.join(element)
+        yield ("way", wayid, element, element)
+
+    for (num,adm) in enumerate(admins):
+        relid = ids.relationId(num, adm)
+        members = [ (ids.wayId(lineid), role)
+                    for lineid, role in relation_members(admins[adm]) ]
+        element = []
+        for memberlist in (sorted(members), members):
+            lines = [ '  <relation id="%d" version="0">\n' % relid ]
+            for wayid, role in memberlist:
+                lines.append('    <member type="way" ref="%d" role="%s"/>\n'
+                             % (wayid, role))
+            for key, value in relation_tags(admins[adm]):
+                lines.append('    <tag k="%s" v="%s"/>\n' % (key, value))
+            lines.append('  </relation>\n')
+            element.append(''.join(lines))
+        yield ("relation", relid, element[0], element[1])
+
+
+def index_entries(shapeu, admins, ids):
+    """
+    Generator function on (type, id, digest) of each object.
+    """
+
+    for objtype, objid, key, element in osm_elements(shapeu, admins, ids):
+        yield (objtype, objid, hashlib.md5(key).hexdigest())
+
+
+def write_index(filename, shapeu, admins, ids):
+    """
+    Write the index of a run: type, id and digest of each object.
+    """
+
+    out = writeosm.ThreadWriter(filename)
+    for entry in index_entries(shapeu, admins, ids):
+        out.write("%s %d %s\n" % entry)
+    out.close()
+
+
+def read_index(filename):
+    """
+    Read the index of a previous run (see write_index), or the index
+    kept in the SQLite store of the run (see sqlite_osm.save_index).
+
+    Return a dictionary (type, id) -> digest.
+    """
+
+    if sqlite_osm.isstore(filename):
+        db = sqlite_osm.connect(filename)
+        index = sqlite_osm.read_index(db)
+        db.close()
+        return index
+    index = {}
+    for line in open(filename):
+        objtype, objid, digest = line.split()
+        index[(objtype, int(objid))] = digest
+    return index
+
+
+def write_uganda_diff(filename, shapeu, admins, ids, previous):
+    """
+    Write an osmChange file with objects created, modified, deleted since
+    the run described by the index 'previous' (see read_index).
+
+    The index of the current run is written in filename + '.idx'.
+    """
+
+    logo.starting("Saving changes",
+                  shapeu.nbrPoints() + shapeu.nbrLines() + len(admins))
+    previous = dict(previous)
+    changes = { "create" : [], "modify" : [] }
+    index = writeosm.ThreadWriter(filename + ".idx")
+    for objtype, objid, key, element in osm_elements(shapeu, admins, ids):
+        logo.progress()
+        digest = hashlib.md5(key).hexdigest()
+        index.write("%s %d %s\n" % (objtype, objid, digest))
+        olddigest = previous.pop((objtype, objid), None)
+        if olddigest is None:
+            changes["create"].append(element)
+        elif olddigest != digest:
+            changes["modify"].append(element)
+    index.close()
+
+    # Objects not seen are deleted, relations first
+    deleted = []
+    for objtype in ("relation", "way", "node"):
+        for key in sorted([ key for key in previous if key[0] == objtype ]):
+            deleted.append('  <%s id="%d" version="0"/>\n' % key)
+    logo.INFO("Changes: %d created, %d modified, %d deleted",
+              len(changes["create"]), len(changes["modify"]), len(deleted))
+
+    out = writeosm.ThreadWriter(filename)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<osmChange version="0.6" generator="test">\n')
+    for action, elements in (("create", changes["create"]),
+                             ("modify", changes["modify"]),
+                             ("delete", deleted)):
+        if elements:
+            out.write('<%s>\n' % action)
+            out.write(''.join(elements))
+            out.write('</%s>\n' % action)
+    out.write('</osmChange>\n')
+    out.close()
+    logo.ending()
+
+
+def write_geojson(filename, admins, extent=False):
+    """
+    Write admin areas as GeoJSON MultiPolygon features.
+
+    Areas need the polygons kept by verify_admin, with 'extent' each
+    feature also has its bbox and its area (square meters) in properties.
+    """
+
+    logo.starting("Saving GeoJSON", len(admins))
+    out = writeosm.ThreadWriter(filename)
+    out.write('{"type": "FeatureCollection", "features": [\n')
+    for num, adm in enumerate(sorted(admins)):
+        logo.progress()
+        admin = admins[adm]
+        properties = { "name" : admin["name"], "admin_level" : admin["level"] }
+        if "old_name" in admin:
+            properties["old_name"] = admin["old_name"]
+        if extent:
+            properties["area"] = round(admin["area"], 1)
+        feature = [ '{"type": "Feature", "id": %s, "properties": %s, '
+                    % (json.dumps(str(adm)), json.dumps(properties,
+                                                        sort_keys=True)) ]
+        if extent and admin["bbox"] is not None:
+            xmin, xmax, ymin, ymax = admin["bbox"]
+            feature.append('"bbox": [%.7f, %.7f, %.7f, %.7f], '
+                           % (xmin, ymin, xmax, ymax))
+        feature.append('"geometry": {"type": "MultiPolygon", "coordinates": [')
+        feature.append(', '.join([
+            '[' + ', '.join([
+                '[' + ', '.join([ '[%.7f, %.7f]' % coord for coord in ring ])
+                + ']'
+                for ring in [ outer ] + inners ]) + ']'
+            for outer, inners in admin["polygons"] ]))
+        feature.append(']}}')
+        if num:
+            out.write(',\n')
+        out.write(''.join(feature))
+    out.write('\n]}\n')
+    out.close()
+    logo.ending()
+
+
+def write_wkb(filename, admins, extent=False):
+    """
+    Write admin areas as rows of WKB MultiPolygon in a flat binary file.
+
+    The file starts with 'UGWKB' and a flag byte (1 = with extent), then
+    for each area (little endian) :
+    - uint32 size of the row (not counting this field)
+    - uint16 size + key, uint16 size + name (UTF8), uint8 admin level
+    - with extent : 5 doubles xmin, ymin, xmax, ymax, area (square meters)
+    - uint32 size + WKB geometry
+    """
+
+    logo.starting("Saving WKB", len(admins))
+    out = writeosm.ThreadWriter(filename)
+    out.write("UGWKB" + struct.pack("<B", int(extent)))
+    for adm in sorted(admins):
+        logo.progress()
+        admin = admins[adm]
+        key = str(adm)
+        row = [ struct.pack("<H", len(key)), key,
+                struct.pack("<H", len(admin["name"])), admin["name"],
+                struct.pack("<B", admin["level"]) ]
+        if extent:
+            xmin, xmax, ymin, ymax = admin["bbox"] or (0.0, 0.0, 0.0, 0.0)
+            row.append(struct.pack("<5d", xmin, ymin, xmax, ymax,
+                                   admin["area"]))
+        wkb = writeosm.wkb_multipolygon(admin["polygons"])
+        row.append(struct.pack("<I", len(wkb)))
+        row.append(wkb)
+        row = ''.join(row)
+        out.write(struct.pack("<I", len(row)) + row)
+    out.close()
+    logo.ending()
+
+
+def load_UGANDA_OSM(filename):
+    """
+    Parse the OSM file and extract relations and geometry of their ways.
+
+    Return ((relations, ways), debug messages) where relations is a list
+    of (relationid, tags, wayids) and ways a dictionary of string of packed
+    doubles (lon, lat, lon, lat, ...) (this can run in a worker process).
+    """
+
+    parseosm.clear()
     parseosm.parse_xml(open(filename).read())
-    shapeutil.precision = 14  # don't do aggressive rounding
-    shapeutil.testnearest = []  # nor neighbour hack
 
-    # Read each polygon and build the connection arrays (point, segment, line)
-    logo.starting("Geometry read", parseosm.getNbRelation())
+    relations = []
+    ways = {}
+    logo.starting("Geometry load", parseosm.getNbRelation())
     for relationid in parseosm.getIterRelation():
         logo.progress()
         relation = parseosm.getRelation(relationid)
         wayids = [ data[1] for data in relation['members']
                    if data[0] == 'way' and data[2] in ('outer', 'inner') ]
+        relations.append( (relationid, relation['tags'], wayids) )
 
         for wayid in wayids:
-            linegeometry = parseosm.getGeometryWay(wayid)
-            lon1, lat1 = linegeometry[0]
-            for lon2, lat2 in linegeometry[1:]:
-                shapeu.makeSegment(lon1, lat1, lon2, lat2)
-                lon1, lat1 = lon2, lat2
+            if wayid not in ways:
+                coords = array.array('d')
+                for coord in parseosm.getGeometryWay(wayid):
+                    coords.extend(coord)
+                ways[wayid] = coords.tostring()
     logo.ending()
+    return ((relations, ways), [])
 
 
-def admin_UGANDA_OSM(filename, shapeu, admins):
-    logo.starting("Attributes read", parseosm.getNbRelation())
-    for relationid in parseosm.getIterRelation():
+def read_UGANDA_OSM(osmdata, shapeu):
+    """
+    Build the geometry from the relations of an OSM file
+    (see load_UGANDA_OSM).
+
+    Return the relations and a dictionary of ways used by relations, each
+    way being a flat array of rounded coordinates (lon, lat, lon, lat, ...).
+    """
+
+    shapeutil.precision = 14  # don't do aggressive rounding
+    shapeutil.testnearest = []  # nor neighbour hack
+
+    # Read each polygon and build the connection arrays (point, segment, line)
+    relations, waysdata = osmdata
+    ways = {}
+    logo.starting("Geometry read", len(relations))
+    for relationid, tags, wayids in relations:
         logo.progress()
-        relation = parseosm.getRelation(relationid)
+        for wayid in wayids:
+            if wayid not in ways:
+                line = array.array('d')
+                line.fromstring(waysdata[wayid])
+                ways[wayid] = shapeu.addLine(itertools.izip(line[0::2],
+                                                            line[1::2]))
+    shapeu.flushCounts()
+    logo.ending()
+    return (relations, ways)
+
 
-        admins[relationid] = { "name" : relation['tags']['name'],
-                               "level" : int(relation['tags']['admin_level']),
+def admin_UGANDA_OSM(osmdata, shapeu, admins):
+    relations, ways = osmdata
+    logo.starting("Attributes read", len(relations))
+    for relationid, tags, wayids in relations:
+        logo.progress()
+
+        admins[relationid] = { "name" : tags['name'],
+                               "level" : int(tags['admin_level']),
                                "inner" : set(),
                                "outer" : set(),
                              }
-        if 'old_name' in relation['tags']:
-            admins[relationid]["old_name"] = relation['tags']['old_name']
+        if 'old_name' in tags:
+            admins[relationid]["old_name"] = tags['old_name']
 
-        wayids = [ data[1] for data in relation['members']
-                   if data[0] == 'way' and data[2] in ('outer', 'inner') ]
         lineset = set()
         for wayid in wayids:
             pntinring = []
-            linegeometry = parseosm.getGeometryWay(wayid)
-            for lon, lat in linegeometry:
-                pointid = shapeu.getPoint(lon, lat)
+            coords = ways[wayid]
+            for pnt in xrange(0, len(coords), 2):
+                pointid = shapeu.getPointRounded( (coords[pnt], coords[pnt+1]) )
                 if pointid is not None:
                     pntinring.append(pointid)
 
@@ -413,36 +1428,250 @@ def admin_UGANDA_OSM(filename, shapeu, admins):
     logo.ending()
 
 
-def main():
-    logo.init(filename = uganda_config.logfile,
-              verbose = uganda_config.verbose,
-              progress = uganda_config.progress)
-    if len(sys.argv) < 2:
-        raise logo.ERROR("Missing input Shapefile")
+def load_input(filename):
+    """
+    Load an input file (shapefile or OSM file), can run in a worker process.
+
+    Return (filename, data, debug messages).
+    """
+
+    if filename.endswith(".osm"):
+        data, messages = load_UGANDA_OSM(filename)
+    else:
+        data, messages = load_UGANDA(filename)
+    return (filename, data, messages)
+
 
+def build_UGANDA(filenames, workers=1, shapes=False):
+    """
+    Read the input files, simplify the lines and build the verified
+    administrative areas (with their shape if 'shapes', see
+    verify_admin).
+
+    Return (shapeu, admins).
+    """
+
+    # Files are loaded (read, reprojected) in parallel but merged in the
+    # command line order, rounding and gluing points depend on the points
+    # already seen
     shapeu = shapeutil.ShapeUtil(uganda_config.cachesize)
-    for i in xrange(1, len(sys.argv)):
-        logo.INFO("Reading geometries '%s'" % sys.argv[i])
-        if sys.argv[i].endswith(".osm"):
-            read_UGANDA_OSM(sys.argv[i], shapeu)
+    inputs = []
+    if workers > 1 and len(filenames) > 1:
+        logo.flush()
+        pool = multiprocessing.Pool(min(workers, len(filenames)), logo.detach)
+        loaded = pool.imap(load_input, filenames)
+    else:
+        pool = None
+        loaded = itertools.imap(load_input, filenames)
+    for filename, data, messages in loaded:
+        logo.INFO("Reading geometries '%s'", filename)
+        for text, textargs in messages:
+            logo.DEBUG(text, *textargs)
+        if filename.endswith(".osm"):
+            with logo.span("read_UGANDA_OSM", file=filename):
+                features = read_UGANDA_OSM(data, shapeu)
         else:
-            read_UGANDA(sys.argv[i], shapeu)
+            with logo.span("read_UGANDA", file=filename):
+                features = read_UGANDA(data, shapeu)
+        inputs.append( (filename, features) )
+        if filename.endswith(".osm"):
+            nbrfeatures = len(features[0]) + len(features[1])
+        else:
+            nbrfeatures = len(features)
+        logo.gauge("input_features", nbrfeatures,
+                   "Relations and ways or polygons read", file=filename)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logo.INFO("Simplify geometries")
-    shapeu.buildSimplifiedLines()
+    pointsbefore = shapeu.nbrPoints()
+    logo.gauge("points", pointsbefore, "Points of the lines",
+               stage="read")
+    logo.gauge("segments", shapeu.segment_count / 2,
+               "Segments before simplification")
+    with logo.span("buildSimplifiedLines"):
+        shapeu.buildSimplifiedLines()
+    logo.gauge("points", shapeu.nbrPoints(), "Points of the lines",
+               stage="simplified")
+    logo.gauge("lines", shapeu.nbrLines(), "Simplified lines")
+    if pointsbefore:
+        logo.gauge("simplification_ratio",
+                   float(shapeu.nbrPoints()) / pointsbefore,
+                   "Points kept by the simplification")
 
     logo.INFO("Building administrative area")
     admins = {}
-    for i in xrange(1, len(sys.argv)):
-        if sys.argv[i].endswith(".osm"):
-            admin_UGANDA_OSM(sys.argv[i], shapeu, admins)
+    for filename, features in inputs:
+        if filename.endswith(".osm"):
+            admin_UGANDA_OSM(features, shapeu, admins)
         else:
-            admin_UGANDA(sys.argv[i], shapeu, admins)
+            admin_UGANDA(features, shapeu, admins)
     logo.INFO("Verifying administrative area")
-    verify_admin(shapeu, admins)
+    with logo.span("verify_admin"):
+        verify_admin(shapeu, admins, workers,
+                     uganda_config.ringmaxattempts, uganda_config.ringmaxtime,
+                     shapes)
+    levels = collections.Counter([ admin["level"]
+                                   for admin in admins.itervalues() ])
+    for level in levels:
+        logo.gauge("admins", levels[level], "Administrative areas",
+                   level=level)
+    return shapeu, admins
+
+
+def main():
+    parser = optparse.OptionParser(
+                usage="%prog [options] file.shp|file.osm [file ...]"
+                      "|store.sqlite")
+    parser.add_option("-f", "--format", choices=("osm", "pbf"),
+                      default="osm",
+                      help="output format: osm (XML) or pbf [%default]")
+    parser.add_option("-o", "--output",
+                      help="output file name, compressed if ending with"
+                           " .gz or .bz2 [<first input>_out.osm]")
+    parser.add_option("--order", choices=("none", "hilbert", "zorder"),
+                      default="none",
+                      help="renumber and write nodes along a space filling"
+                           " curve (none, hilbert, zorder) [%default]")
+    parser.add_option("--shard", action="store_true", default=False,
+                      help="write one file per top level area (named from"
+                           " the output file and the area) and a manifest"
+                           " of the ways shared by several files")
+    parser.add_option("--geojson", metavar="FILE",
+                      help="also export the admin areas as GeoJSON"
+                           " polygons in FILE")
+    parser.add_option("--wkb", metavar="FILE",
+                      help="also export the admin areas as WKB polygons"
+                           " in FILE")
+    parser.add_option("--extent", action="store_true", default=False,
+                      help="add bbox and area to the GeoJSON/WKB export")
+    parser.add_option("--report", metavar="FILE",
+                      help="write a JSON report of the run (time, memory"
+                           " and counters by phase) in FILE")
+    parser.add_option("--trace", metavar="FILE",
+                      help="write a trace of the phases, lines and areas"
+                           " (Chrome trace event format) in FILE")
+    parser.add_option("--metrics", metavar="FILE",
+                      help="write the run metrics in FILE (Prometheus"
+                           " textfile collector format, .prom)")
+    parser.add_option("--metrics-port", metavar="PORT", type="int",
+                      help="serve the run metrics over HTTP on the local"
+                           " port PORT, until interrupted once done")
+    parser.add_option("--database", metavar="DSN",
+                      help="also load the result in the uganda_* tables"
+                           " of the PostgreSQL database DSN"
+                           " (e.g. 'dbname=osmosis')")
+    parser.add_option("--recreate", action="store_true", default=False,
+                      help="drop and create again the uganda_* tables of"
+                           " --database or --sqlite, instead of emptying"
+                           " the existing ones")
+    parser.add_option("--sqlite", metavar="FILE",
+                      help="also store the topology, the admin areas and"
+                           " the result in the SQLite database FILE, it"
+                           " can be given as input instead of the files")
+    parser.add_option("--stable-ids", action="store_true", default=False,
+                      help="ids derived from the content, identical between"
+                           " runs, an index is written in <output>.idx")
+    parser.add_option("--diff", metavar="INDEX",
+                      help="only write an osmChange (.osc) file with the"
+                           " changes since the run of the index INDEX or"
+                           " of the SQLite store INDEX (implies"
+                           " --stable-ids)")
+    (options, args) = parser.parse_args()
+    if options.diff:
+        options.stable_ids = True
+    if options.stable_ids and options.shard:
+        parser.error("--stable-ids (or --diff) and --shard are mutually"
+                     " exclusive")
+    if options.stable_ids and options.order != "none":
+        parser.error("--order and --stable-ids are mutually exclusive")
+    if options.database and psycopg2 is None:
+        parser.error("--database needs psycopg2")
+
+    logo.init(filename = uganda_config.logfile,
+              verbose = uganda_config.verbose,
+              progress = uganda_config.progress)
+    if options.trace:
+        logo.trace()
+    logo.declare("rings_not_closed_total", "counter",
+                 "Areas with a ring not closed")
+    if options.metrics_port:
+        logo.serveMetrics(options.metrics_port)
+    if len(args) < 1:
+        raise logo.ERROR("Missing input Shapefile")
+
+    workers = uganda_config.workers or multiprocessing.cpu_count()
+
+    if len(args) == 1 and sqlite_osm.isstore(args[0]):
+        logo.INFO("Reading topology '%s'", args[0])
+        with logo.span("load_topology", file=args[0]):
+            db = sqlite_osm.connect(args[0])
+            shapeu, admins = sqlite_osm.load_topology(db,
+                                                      uganda_config.cachesize)
+            db.close()
+    else:
+        shapeu, admins = build_UGANDA(args, workers,
+                                      options.geojson or options.wkb
+                                      or options.sqlite)
+    if options.geojson:
+        write_geojson(options.geojson, admins, options.extent)
+    if options.wkb:
+        write_wkb(options.wkb, admins, options.extent)
 
     logo.INFO("Writing output file")
-    write_uganda(os.path.splitext(sys.argv[1])[0], shapeu, admins)
+    if options.stable_ids:
+        ids = StableOsmIds(shapeu)
+    elif options.order != "none":
+        ids = SpatialOsmIds(shapeu, options.order)
+    else:
+        ids = OsmIds(shapeu)
+    fileout = options.output
+    if options.diff:
+        if not fileout:
+            fileout = os.path.splitext(args[0])[0] + "_out.osc"
+        write_uganda_diff(fileout, shapeu, admins, ids,
+                          read_index(options.diff))
+    else:
+        if options.format == "pbf":
+            writer, suffix = write_uganda_pbf, "_out.osm.pbf"
+        else:
+            writer, suffix = write_uganda, "_out.osm"
+        if not fileout:
+            fileout = os.path.splitext(args[0])[0] + suffix
+        with logo.span(writer.__name__, file=fileout):
+            if options.shard:
+                write_shards(fileout, writer, shapeu, admins, ids, workers)
+            else:
+                writer(fileout, shapeu, admins, ids)
+    if options.stable_ids and not options.diff:
+        write_index(fileout + ".idx", shapeu, admins, ids)
+    if options.database:
+        with logo.span("write_uganda_db", database="postgresql"):
+            db = psycopg2.connect(options.database)
+            write_uganda_db(db, sql_osm, shapeu, admins, ids,
+                            options.recreate)
+            db.close()
+    if options.sqlite:
+        with logo.span("write_uganda_db", database="sqlite"):
+            db = sqlite_osm.connect(options.sqlite)
+            sqlite_osm.save_topology(db, shapeu, admins)
+            write_uganda_db(db, sqlite_osm, shapeu, admins, ids,
+                            options.recreate)
+            if options.stable_ids:
+                sqlite_osm.save_index(db, index_entries(shapeu, admins, ids))
+            db.close()
+    if options.report:
+        logo.writeReport(options.report)
+    if options.trace:
+        logo.writeTrace(options.trace)
+    if options.metrics:
+        logo.writeMetrics(options.metrics)
+    if options.metrics_port:
+        logo.INFO("Serving metrics on port %d, interrupt to stop",
+                  options.metrics_port)
+        logo.flush()
+        logo.waitMetrics()
     logo.close()
 
 
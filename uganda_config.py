@@ -48,6 +48,17 @@ progress = True
 # hungry), a reasonable value is the number of points in the Shapefile.
 cachesize = 3800000
 
+# ringmaxattempts, ringmaxtime = search budget (number of rings assembled
+#           and seconds) when building the rings of one admin area, when
+#           exceeded the lines not forming a valid ring are discarded
+#           (0 = no limit)
+ringmaxattempts = 100000
+ringmaxtime = 120
+
+# workers = number of processes used for parallel tasks (0 = number of CPU,
+#           1 = everything done in the main process)
+workers = 0
+
 if __name__ == '__main__':
     print "***WARNING*** THIS FILE IS NOT MEANT TO BE RUN"
     print "It is used to set some global configuration variable used by 'caop' programs."
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Licensed under the GNU General Public License Version 2 or later
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Output file helpers.
+"""
+
+import threading
+import Queue
+import struct
+import zlib
+import bz2
+import multiprocessing
+import multiprocessing.pool
+import logo
+
+
+def compress_gzip(data):
+    """ Return data as a complete gzip member. """
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_bz2(data):
+    """ Return data as a complete bzip2 stream. """
+
+    return bz2.compress(data, 9)
+
+
+class ThreadWriter:
+    """
+    Write a file from a background thread.
+
+    Data is accumulated in the caller thread and handed by big blocks
+    to the writer thread, formatting overlaps with disk I/O.
+    When 'filename' ends with '.gz' or '.bz2' each block is compressed
+    independently by a pool of 'workers' threads and written as a gzip
+    member or bzip2 stream (concatenated members, like pigz/pbzip2).
+    """
+
+    def __init__(self, filename, blocksize=1<<20, maxblocks=8, workers=None):
+        self.out = open(filename, "wb", blocksize)
+        self.blocksize = blocksize
+        self.pending = []
+        self.pendingsize = 0
+        self.byteswritten = 0
+        self.error = None
+        if filename.endswith(".gz"):
+            self.compress = compress_gzip
+        elif filename.endswith(".bz2"):
+            self.compress = compress_bz2
+        else:
+            self.compress = None
+        if self.compress is not None:
+            workers = workers or multiprocessing.cpu_count()
+            self.pool = multiprocessing.pool.ThreadPool(workers)
+            maxblocks = max(maxblocks, workers*2)
+        self.queue = Queue.Queue(maxblocks)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def write(self, data):
+        """
+        Add data to the current block, queue the block when full.
+        """
+
+        self.pending.append(data)
+        self.pendingsize += len(data)
+        if self.pendingsize >= self.blocksize:
+            self._queueblock()
+
+
+    def close(self):
+        """
+        Write the remaining data and wait for the writer thread.
+        """
+
+        self._queueblock()
+        self.queue.put(None)
+        self.thread.join()
+        self.out.close()
+        if self.compress is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.error is not None:
+            raise self.error
+        logo.count("bytes written", self.byteswritten)
+
+
+    def _queueblock(self):
+        if self.error is not None:
+            raise self.error
+        if self.pending:
+            data = ''.join(self.pending)
+            if self.compress is not None:
+                # Compress in the pool, the writer waits the result in order
+                data = self.pool.apply_async(self.compress, (data,))
+            self.queue.put(data)
+            self.pending = []
+            self.pendingsize = 0
+
+
+    def _run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    if self.compress is not None:
+                        data = data.get()
+                    self.out.write(data)
+                    self.byteswritten += len(data)
+                except Exception, inst:
+                    self.error = inst
+
+
+#
+# OSM PBF format (hand made protocol buffers encoding)
+#
+
+def pbf_varint(value):
+    """ Encode an unsigned (or int64 when negative) varint. """
+
+    if value < 0:
+        value &= 0xFFFFFFFFFFFFFFFF
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def pbf_zigzag(value):
+    """ Encode a signed (sint64) varint. """
+
+    if value < 0:
+        return pbf_varint((-value << 1) - 1)
+    return pbf_varint(value << 1)
+
+
+def pbf_field(num, data):
+    """ Encode a length delimited field (string, message, packed). """
+
+    return pbf_varint((num << 3) | 2) + pbf_varint(len(data)) + data
+
+
+def pbf_uint(num, value):
+    """ Encode a varint field. """
+
+    return pbf_varint(num << 3) + pbf_varint(value)
+
+
+def pbf_packed(num, values, delta=False, signed=False):
+    """ Encode a packed repeated field, optionally delta coded. """
+
+    if delta:
+        prev = 0
+        deltas = []
+        for value in values:
+            deltas.append(value - prev)
+            prev = value
+        values = deltas
+    if signed:
+        return pbf_field(num, ''.join([ pbf_zigzag(v) for v in values ]))
+    return pbf_field(num, ''.join([ pbf_varint(v) for v in values ]))
+
+
+class PbfWriter:
+    """
+    Write an OSM PBF file.
+
+    Nodes are stored as dense nodes, ids, coordinates and member
+    references are delta coded, each block is a zlib compressed blob.
+    Objects must be added in order: nodes, ways, relations.
+    """
+
+    GROUP_DENSE, GROUP_WAYS, GROUP_RELATIONS = (2, 3, 4)
+    MEMBER_TYPE = { "node" : 0, "way" : 1, "relation" : 2 }
+
+    def __init__(self, filename, generator="test", blocksize=8000):
+        self.out = ThreadWriter(filename)
+        self.blocksize = blocksize
+        self.grouptype = None
+        self.group = []
+        self.strings = {}
+        self.stringlist = []
+        header = (pbf_field(4, "OsmSchema-V0.6")
+                  + pbf_field(4, "DenseNodes")
+                  + pbf_field(16, generator))
+        self._writeblob("OSMHeader", header)
+
+
+    def addNode(self, nodeid, lon, lat):
+        """ Add a node (without tags). """
+
+        self._setgroup(self.GROUP_DENSE)
+        self.group.append( (nodeid, int(round(lat * 10000000)),
+                                    int(round(lon * 10000000))) )
+
+
+    def addWay(self, wayid, nodeids, tags):
+        """ Add a way, 'tags' is a list of (key, value). """
+
+        self._setgroup(self.GROUP_WAYS)
+        self.group.append( (wayid, nodeids, tags) )
+
+
+    def addRelation(self, relid, members, tags):
+        """
+        Add a relation, 'members' is a list of (type, ref, role) and 'tags'
+        a list of (key, value).
+        """
+
+        self._setgroup(self.GROUP_RELATIONS)
+        self.group.append( (relid, members, tags) )
+
+
+    def close(self):
+        """ Flush the last block and close the file. """
+
+        self._flushgroup()
+        self.out.close()
+
+
+    def _setgroup(self, grouptype):
+        if self.grouptype != grouptype or len(self.group) >= self.blocksize:
+            self._flushgroup()
+            self.grouptype = grouptype
+
+
+    def _stringid(self, text):
+        try:
+            return self.strings[text]
+        except KeyError:
+            self.stringlist.append(text)
+            self.strings[text] = len(self.stringlist)
+            return len(self.stringlist)
+
+
+    def _flushgroup(self):
+        if not self.group:
+            return
+
+        self.strings = {}
+        self.stringlist = []
+        if self.grouptype == self.GROUP_DENSE:
+            group = pbf_field(2, ''.join([
+                      pbf_packed(1, [ n[0] for n in self.group ], True, True),
+                      pbf_packed(8, [ n[1] for n in self.group ], True, True),
+                      pbf_packed(9, [ n[2] for n in self.group ], True, True),
+                    ]))
+        elif self.grouptype == self.GROUP_WAYS:
+            ways = []
+            for wayid, nodeids, tags in self.group:
+                ways.append(pbf_field(3, ''.join([
+                      pbf_uint(1, wayid),
+                      pbf_packed(2, [ self._stringid(k) for k, v in tags ]),
+                      pbf_packed(3, [ self._stringid(v) for k, v in tags ]),
+                      pbf_packed(8, nodeids, True, True),
+                    ])))
+            group = ''.join(ways)
+        else:
+            relations = []
+            for relid, members, tags in self.group:
+                relations.append(pbf_field(4, ''.join([
+                      pbf_uint(1, relid),
+                      pbf_packed(2, [ self._stringid(k) for k, v in tags ]),
+                      pbf_packed(3, [ self._stringid(v) for k, v in tags ]),
+                      pbf_packed(8, [ self._stringid(m[2]) for m in members ]),
+                      pbf_packed(9, [ m[1] for m in members ], True, True),
+                      pbf_packed(10, [ self.MEMBER_TYPE[m[0]] for m in members ]),
+                    ])))
+            group = ''.join(relations)
+
+        stringtable = ''.join([ pbf_field(1, text)
+                                for text in [ "" ] + self.stringlist ])
+        block = pbf_field(1, stringtable) + pbf_field(2, group)
+        self._writeblob("OSMData", block)
+        self.group = []
+
+
+    def _writeblob(self, blobtype, data):
+        blob = pbf_uint(2, len(data)) + pbf_field(3, zlib.compress(data))
+        header = pbf_field(1, blobtype) + pbf_uint(3, len(blob))
+        self.out.write(struct.pack('>I', len(header)) + header + blob)
+
+
+def wkb_multipolygon(polygons):
+    """
+    Return WKB (little endian) of a MultiPolygon given as a list of
+    (outer ring, list of inner rings) of coordinates.
+    """
+
+    data = [ struct.pack("<BII", 1, 6, len(polygons)) ]
+    for outer, inners in polygons:
+        data.append(struct.pack("<BII", 1, 3, len(inners) + 1))
+        for ring in [ outer ] + inners:
+            data.append(struct.pack("<I", len(ring)))
+            data.append(struct.pack("<%dd" % (len(ring)*2),
+                                    *[ value for coord in ring
+                                       for value in coord ]))
+    return ''.join(data)